@@ -0,0 +1,147 @@
+## aggregate afterpulse spectra (delay times, areas, afterpulses per
+## primary vs primary area, afterpulse probability), filled in bulk from
+## the output of findAPsBatch. partial spectra, e.g. from parallel workers
+## or separate runs, are combined with add(): the histograms hold integer
+## counts and the running sums are fixed-point integers, so they combine
+## exactly in any order
+
+import numpy as np
+
+class Hist(object):
+    # fixed-binning histogram with underflow (counts[0]) and overflow
+    # (counts[-1]) bins
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=float)
+        self.counts = np.zeros(self.edges.size+1, dtype=np.int64)
+
+    def fill(self, x, weights=None):
+        # weights, if given, must be integers
+        idx = np.searchsorted(self.edges, x, side='right')
+        if weights is None:
+            self.counts += np.bincount(idx, minlength=self.counts.size)
+        else:
+            self.counts += np.bincount(idx, weights=weights, minlength=self.counts.size).astype(np.int64)
+
+    def add(self, other):
+        if not np.array_equal(self.edges, other.edges):
+            raise Exception("can't add histograms with different binnings")
+        self.counts += other.counts
+
+class Moments(object):
+    # running count, sum and sum of squares. every value (and its square) is
+    # rounded to a multiple of 1/SCALE and the sums are kept as python
+    # integers, which don't overflow and add up the same in any order
+    SCALE = 2**20
+
+    def __init__(self):
+        self.n = 0
+        self.sum = 0
+        self.sumsq = 0
+
+    def toFixed(self, x):
+        x = np.round(np.asarray(x, dtype=float) * self.SCALE)
+        if x.size > 0 and not np.amax(np.abs(x)) < 2.**62:
+            raise Exception("value out of range for Moments")
+        return int(np.sum(x.astype(np.int64), dtype=object))
+
+    def fill(self, x):
+        x = np.asarray(x, dtype=float)
+        self.n += x.size
+        self.sum += self.toFixed(x)
+        self.sumsq += self.toFixed(x*x)
+
+    def add(self, other):
+        self.n += other.n
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+
+    def mean(self):
+        return self.sum / float(self.n*self.SCALE) if self.n > 0 else np.nan
+
+    def std(self):
+        if self.n < 2:
+            return np.nan
+        # (sumsq - sum^2/n)/(n-1) in integers, divided out once at the end
+        num = self.sumsq*self.SCALE*self.n - self.sum**2
+        return np.sqrt(max(0., num / float(self.SCALE**2 * self.n * (self.n-1))))
+
+class APSpectra(object):
+    def __init__(self, delay_bins=np.linspace(0, 1000, 501), area_bins=np.linspace(0, 200, 401),
+                 primary_area_bins=np.linspace(0, 5000, 101), max_aps=50):
+        # afterpulse delays (afterpulse time - primary tmax) and areas
+        self.delay = Hist(delay_bins)
+        self.area = Hist(area_bins)
+        # number of primaries, and their total number of afterpulses, per
+        # primary area bin, giving the afterpulses per primary vs its area
+        self.primary_area = Hist(primary_area_bins)
+        self.aps_vs_primary_area = Hist(primary_area_bins)
+        # number of afterpulses per primary
+        self.n_aps = Hist(np.arange(max_aps+1))
+        self.delay_moments = Moments()
+        self.area_moments = Moments()
+
+    def fill(self, primary_time, primary_area, aps, good=None):
+        # add the primaries of a batch, with times and areas primary_time and
+        # primary_area ([N]), and their afterpulses as returned by
+        # findAPsBatch. primaries with good=False are left out
+        primary_time = np.asarray(primary_time, dtype=float)
+        primary_area = np.asarray(primary_area, dtype=float)
+        if good is None:
+            good = np.ones(primary_time.size, dtype=bool)
+        nap = np.diff(aps["offsets"])[good]
+        sel = good[aps["event"]]
+        delay = aps["time"][sel] - primary_time[aps["event"][sel]]
+        area = aps["area"][sel]
+
+        self.delay.fill(delay)
+        self.area.fill(area)
+        self.primary_area.fill(primary_area[good])
+        self.aps_vs_primary_area.fill(primary_area[good], nap)
+        self.n_aps.fill(nap)
+        self.delay_moments.fill(delay)
+        self.area_moments.fill(area)
+
+    def add(self, other):
+        for k in ["delay", "area", "primary_area", "aps_vs_primary_area", "n_aps",
+                  "delay_moments", "area_moments"]:
+            getattr(self, k).add(getattr(other, k))
+
+    def n_primaries(self):
+        return int(np.sum(self.n_aps.counts))
+
+    def probability(self):
+        # fraction of primaries with at least one afterpulse
+        n = self.n_primaries()
+        return float(n - self.n_aps.counts[1]) / n if n > 0 else np.nan
+
+    def aps_per_primary(self):
+        # mean number of afterpulses per primary, overall and per primary area bin
+        with np.errstate(invalid="ignore", divide="ignore"):
+            per_bin = self.aps_vs_primary_area.counts / self.primary_area.counts.astype(float)
+        n = self.n_primaries()
+        return (float(self.aps_vs_primary_area.counts.sum()) / n if n > 0 else np.nan), per_bin
+
+    def save(self, fname):
+        out = {}
+        for k in ["delay", "area", "primary_area", "aps_vs_primary_area", "n_aps"]:
+            out[k+"_edges"] = getattr(self, k).edges
+            out[k+"_counts"] = getattr(self, k).counts
+        for k in ["delay_moments", "area_moments"]:
+            m = getattr(self, k)
+            # as strings, since the sums don't fit in any numpy integer
+            out[k] = np.array([str(m.n), str(m.sum), str(m.sumsq)])
+        np.savez(fname, **out)
+
+def loadSpectra(fname):
+    d = np.load(fname)
+    spec = APSpectra(d["delay_edges"], d["area_edges"], d["primary_area_edges"], d["n_aps_edges"].size-1)
+    for k in ["delay", "area", "primary_area", "aps_vs_primary_area", "n_aps"]:
+        getattr(spec, k).counts = d[k+"_counts"]
+    for k in ["delay_moments", "area_moments"]:
+        m = getattr(spec, k)
+        if d[k].dtype.kind in 'SU':
+            m.n, m.sum, m.sumsq = int(d[k][0]), int(d[k][1]), int(d[k][2])
+        else:
+            # saved as floats, before the sums were fixed-point
+            m.n, m.sum, m.sumsq = int(d[k][0]), int(round(d[k][1]*m.SCALE)), int(round(d[k][2]*m.SCALE))
+    return spec
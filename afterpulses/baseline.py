@@ -0,0 +1,55 @@
+## streaming estimate of the baseline waveform of a run: the per-sample mean
+## and median of offset-subtracted waveforms, filled a batch at a time. the
+## median comes from a fixed-binning histogram per sample, so estimators
+## filled separately (e.g. by parallel workers) combine exactly with add()
+
+import numpy as np
+
+# 0.05 mV bins around zero, where the baseline between pulses sits, and
+# 2 mV bins out to the size of the main pulses
+DEFAULT_EDGES = np.concatenate([np.arange(-500., -20., 2.), np.arange(-20., 20., 0.05), np.arange(20., 2000.1, 2.)])
+
+class BaselineEstimator(object):
+    def __init__(self, nsamp=1024, edges=DEFAULT_EDGES):
+        # values outside the edges still count towards the median, in the
+        # under/overflow bins
+        self.edges = np.asarray(edges, dtype=float)
+        nbins = self.edges.size-1
+        self.n = 0
+        self.sum = np.zeros(nsamp)
+        self.counts = np.zeros((nsamp, nbins+2), dtype=np.int64)
+
+    def fill(self, vs):
+        # add a batch of [N,nsamp] offset-subtracted waveforms
+        vs = np.atleast_2d(vs)
+        nsamp, nb = self.counts.shape
+        self.n += vs.shape[0]
+        self.sum += np.sum(vs, axis=0)
+        idx = np.searchsorted(self.edges, vs, side='right') + np.arange(nsamp)*nb
+        self.counts += np.bincount(idx.ravel(), minlength=self.counts.size).reshape(self.counts.shape)
+
+    def add(self, other):
+        if not np.array_equal(self.edges, other.edges) or self.counts.shape != other.counts.shape:
+            raise Exception("can't add baseline estimators with different binnings")
+        self.n += other.n
+        self.sum += other.sum
+        self.counts += other.counts
+
+    def mean(self):
+        return self.sum / self.n
+
+    def median(self):
+        # interpolated linearly within the histogram bin that holds the
+        # median. a median in the under/overflow is clipped to the range
+        nsamp, nb = self.counts.shape
+        rows = np.arange(nsamp)
+        cum = np.cumsum(self.counts, axis=1)
+        half = self.n / 2.
+        ib = np.argmax(cum >= half, axis=1)
+        below = cum[rows,ib] - self.counts[rows,ib]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            frac = np.clip((half - below) / self.counts[rows,ib], 0., 1.)
+        ie = np.clip(ib-1, 0, nb-3)
+        med = self.edges[ie] + frac*(self.edges[ie+1] - self.edges[ie])
+        med = np.where(ib == 0, self.edges[0], med)
+        return np.where(ib == nb-1, self.edges[-1], med)
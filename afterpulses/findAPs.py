@@ -5,8 +5,108 @@ import numpy as np
 import matplotlib.pyplot as plt
 import cPickle as pickle
 
+def findAPsBatch(time, voltage, offset, noise, template, main_peak_end, convolved=None, baseline=None,
+                 remove_neg_spikes=False):
+    # find the afterpulses in a batch of events. time and voltage are
+    # [N,nsamp], offset, noise and main_peak_end [N] arrays or numbers, and
+    # convolved and baseline are optional [N,nconv] and [nsamp] (or [N,nsamp])
+    # arrays. returns the peaks of all of the events as a dict of flat arrays,
+    # in CSR style: the peaks of event i are entries offsets[i]:offsets[i+1]
+    # of "event", "index" (sample of the peak), "end1"/"end2" (samples of its
+    # boundaries), "time", "height", "lowbound"/"highbound" (times of its
+    # boundaries) and "area"
+
+    time = np.atleast_2d(time)
+    nevt, nsamp = time.shape
+    noise = np.broadcast_to(np.asarray(noise, dtype=float), (nevt,))[:,np.newaxis]
+    main_peak_end = np.broadcast_to(np.asarray(main_peak_end, dtype=float), (nevt,))[:,np.newaxis]
+    voltage = np.atleast_2d(voltage) - np.broadcast_to(np.asarray(offset, dtype=float), (nevt,))[:,np.newaxis]
+    if convolved is None:
+        convolved = np.array([np.convolve(v, template[::-1], mode='valid') for v in voltage])
+    convolved = np.atleast_2d(convolved)
+    if baseline is None:
+        baseline = np.zeros(nsamp)
+    baseline = np.broadcast_to(baseline, (nevt, nsamp))
+    raw = voltage
+    if remove_neg_spikes:
+        voltage = voltage*(voltage>baseline-4*noise) + baseline*(voltage<=baseline-4*noise)
+
+    imax = np.argmax(template)
+    ncon = convolved.shape[1]
+    convolved_time = time[:,imax:imax+ncon]
+    convolved_baseline = baseline[:,imax:imax+ncon]
+
+    # candidate peaks are the local maxima of the convolved waveform (over
+    # +-5 samples, clipped at the ends) after the main peak that are more
+    # than 0.75*noise above the baseline. the sliding max is built from
+    # shifted copies of the padded waveform
+    pad = np.full((nevt, 5), -np.inf)
+    padded = np.concatenate([pad, convolved, pad], axis=1)
+    window_max = padded[:,:ncon].copy()
+    for j in range(1, 11):
+        np.maximum(window_max, padded[:,j:j+ncon], out=window_max)
+    evt, cand = np.nonzero((convolved_time > main_peak_end) & (convolved >= window_max) &
+                           (convolved > convolved_baseline + noise*0.75))
+
+    # the largest voltage near each candidate, +-10 bins to each side
+    ois = cand + imax
+    near = ois[:,np.newaxis] + np.arange(-10, 10)
+    inwf = (near >= 0) & (near < nsamp)
+    vnear = np.where(inwf, voltage[evt[:,np.newaxis], np.clip(near, 0, nsamp-1)], -np.inf)
+    imaxnear = near[np.arange(ois.size), np.argmax(vnear, axis=1)]
+
+    # find the boundaries of the peak by tracing until we hit 0 or the endpoints
+    # of the waveform: end1 is the last sample at or before imaxnear that is at
+    # or before main_peak_end or below baseline-noise/2, and end2 the first one
+    # at or after imaxnear that is below baseline-noise/2 or at the end. the
+    # searches run over the flattened batch, with indices row*nsamp+sample
+    above = voltage > baseline-noise/2
+    stop1 = np.flatnonzero((time <= main_peak_end) | ~above)
+    stop2 = ~above
+    stop2[:,-1] = True
+    stop2 = np.flatnonzero(stop2)
+    row0 = evt*nsamp
+    pos1 = np.searchsorted(stop1, row0+imaxnear, side='right') - 1
+    end1 = np.where(pos1 >= 0, stop1[np.maximum(pos1, 0)], -1) - row0
+    end2 = stop2[np.searchsorted(stop2, row0+imaxnear, side='left')] - row0
+
+    # don't count if we've hit a boundary, or if something went wrong and
+    # our original peak isn't in our found boundaries
+    good = (end1 >= 0)
+    good[good] &= time[evt[good],end1[good]] > main_peak_end[evt[good],0]
+    good &= (end2 != nsamp-1) & (end1 <= ois) & (ois <= end2)
+    evt, ois, end1, end2 = evt[good], ois[good], end1[good], end2[good]
+
+    # make sure we don't double count: of consecutive peaks in an event with
+    # the same boundaries, keep the first one with the highest convolved maximum
+    if ois.size > 0:
+        newgroup = np.concatenate([[True], (evt[1:] != evt[:-1]) | (end1[1:] != end1[:-1]) | (end2[1:] != end2[:-1])])
+        group = np.cumsum(newgroup)
+        order = np.lexsort((np.arange(ois.size), -convolved[evt,ois-imax], group))
+        first = np.concatenate([[True], group[order][1:] != group[order][:-1]])
+        keep = np.sort(order[first])
+        evt, ois, end1, end2 = evt[keep], ois[keep], end1[keep], end2[keep]
+
+    # areas from cumulative sums of the trapezoids between samples
+    y = voltage - baseline
+    cum = np.zeros((nevt, nsamp))
+    np.cumsum(np.diff(time, axis=1) * (y[:,1:] + y[:,:-1]) / 2.0, axis=1, out=cum[:,1:])
+
+    return {"offsets": np.concatenate([[0], np.cumsum(np.bincount(evt, minlength=nevt))]),
+            "event": evt,
+            "index": ois,
+            "end1": end1,
+            "end2": end2,
+            "time": time[evt,ois],
+            "height": raw[evt,ois],
+            "lowbound": time[evt,end1],
+            "highbound": time[evt,end2],
+            "area": cum[evt,end2] - cum[evt,end1]}
+
 def findAPs(time, voltage, offset, noise, template, main_peak_start, main_peak_end, plot=False, outName=None, 
             convolved=None, baseline=None, remove_neg_spikes=False):
+    # the afterpulses in a single event, as a list of (peak index, (low
+    # boundary, high boundary), area), optionally plotted to outName
 
     voltage = np.array(voltage)-offset
     if convolved is None:
@@ -18,45 +118,10 @@ def findAPs(time, voltage, offset, noise, template, main_peak_start, main_peak_e
 
     imax = np.argmax(template)
     convolved_time = time[imax:imax+convolved.size]
-    convolved_baseline = baseline[imax:imax+convolved.size]
-
-    max_inds = []
-    for i in range(convolved.size):
-        if convolved_time[i] > main_peak_end and convolved[i] >= np.amax(convolved[max(0,i-5):min(convolved.size,i+6)]) and convolved[i] > convolved_baseline[i] + noise*0.75:
-            oi = i + imax
-
-            # argmax finds the index of the maximum value
-            # in this case, find the largest voltage near the found peak, +-10 bins to each side
-            imaxnear = np.argmax(voltage[oi-10:oi+10]) + (oi-10)
-            end1, end2 = imaxnear, imaxnear
-
-            # find the boundaries of the peak by tracing until we hit 0 or the endpoints of the waveform
-            while time[end1] > main_peak_end and (voltage[end1] > baseline[end1]-noise/2):
-                end1 -= 1
-            while  end2 < voltage.size-1 and (voltage[end2] > baseline[end2]-noise/2):
-                end2 += 1
-            
-            # don't count if we've hit a boundary
-            if time[end1] <= main_peak_end or end2 == voltage.size-1:
-                continue
-            # if something went wrong and our original peak isn't in our found boundaries
-            if not end1 <= oi <= end2:
-                continue
-
-            # make sure we don't double count
-            if len(max_inds)>0 and (end1, end2) == max_inds[-1][1]:
-                # same boundaries, but this one has a higher maximum
-                # delete previous one and save this one
-                if convolved[oi-imax] > convolved[max_inds[-1][0]-imax]:
-                    max_inds = max_inds[:-1]
-                # same boundaries, but previous one has a higher maximum
-                # skip this one
-                else:
-                    continue
-
-            area = np.trapz(voltage[end1:end2+1]-baseline[end1:end2+1], time[end1:end2+1])
-            max_inds.append((oi, (end1, end2), area))
 
+    aps = findAPsBatch(time, voltage, 0, noise, template, main_peak_end, convolved[np.newaxis,:], baseline)
+    max_inds = [(oi, (e1, e2), area) for oi,e1,e2,area in
+                zip(aps["index"].tolist(), aps["end1"].tolist(), aps["end2"].tolist(), aps["area"])]
 
     if plot and outName is not None:
         plt.figure(1, figsize=(12,9))
@@ -1,9 +1,14 @@
 import os, sys
+import multiprocessing
 import ROOT as r
 import numpy as np
 import cPickle as pickle
 import matplotlib.pyplot as plt
-from findAPs import findAPs
+from findAPs import findAPsBatch
+from apspectra import APSpectra
+from baseline import BaselineEstimator
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import treeio
 
 # t0 = 140
 t0 = 75
@@ -12,13 +17,31 @@ minamp = 300
 
 Nevt = -1
 plotFirst = 0
+# events are processed in ranges of chunkSize entries, spread over njobs
+# processes and merged back in entry order
+njobs = multiprocessing.cpu_count()
+chunkSize = 1000
 make_output_tree = True
+# write only the derived branches, as a Features tree in <input>_features.root
+# that can be added as a friend of the input Events tree, instead of a copy
+# of the waveforms with the branches added
+friend_tree = False
+# fill afterpulse delay/area spectra, afterpulses per primary vs primary area
+# and the afterpulse probability directly, into <input>_apspectra.npz. with
+# make_output_tree = False, nothing is written per event
+accumulate = False
+# the baseline waveform is read from scripts/baseline_pickles/<run>.pkl. if
+# that doesn't exist yet, it's estimated (the per-sample median or mean of
+# the offset-subtracted waveforms) in a pre-pass over baseline_nsample events
+# spread through the run (all of them if <= 0), and saved there
+baseline_nsample = 20000
+baseline_estimate = "median"
 
 f = r.TFile(sys.argv[1])
 t = f.Get("Events")
 print "Reading from:", sys.argv[1]
 
-outname = sys.argv[1].split(".")[0] + "_postprocessed.root"
+outname = sys.argv[1].split(".")[0] + ("_features.root" if friend_tree else "_postprocessed.root")
 bn = sys.argv[1].split("/")[-1].split(".")[0]
 outdir = "/home/users/bemarsh/public_html/milliqan/aps/{0}".format(sys.argv[1].split("/")[-1].split(".")[0])
 os.system("mkdir -p "+outdir)
@@ -32,8 +55,6 @@ if plotFirst>0:
     print "Plotting to:", outdir
     plt.figure(1, figsize=(12,9))
 
-times = np.zeros(1024, dtype=float)
-voltages = np.zeros(1024, dtype=float)
 area = np.array([0], dtype=float)
 offset = np.array([0], dtype=float)
 noise = np.array([0], dtype=float)
@@ -43,50 +64,42 @@ tmax = np.array([0], dtype=float)
 tstart = np.array([0], dtype=float)
 tend = np.array([0], dtype=float)
 thalfmax = np.array([0], dtype=float)
-n_APs = np.array([0], dtype=int)
-AP_time = np.zeros(100, dtype=float)
-AP_area = np.zeros(100, dtype=float)
-AP_height = np.zeros(100, dtype=float)
-AP_lowbound = np.zeros(100, dtype=float)
-AP_highbound = np.zeros(100, dtype=float)
+scalars = [area, offset, noise, raw_max, smoothed_max, tmax, tstart, tend, thalfmax]
+scalar_names = ["area", "offset", "noise", "raw_max", "smoothed_max", "tmax", "tstart", "tend", "thalfmax"]
+# afterpulse branches, and the findAPsBatch outputs they're filled from
+ap_names = [("afterpulse_time", "time"), ("afterpulse_area", "area"), ("afterpulse_height", "height"),
+            ("afterpulse_lowbound", "lowbound"), ("afterpulse_highbound", "highbound")]
 
 if Nevt<0:
     Nevt = t.GetEntries()
 t.SetBranchStatus("*", 0)
 t.SetBranchStatus("times", 1)
 t.SetBranchStatus("voltages", 1)
-nt = t.CloneTree(Nevt)
-
-nt.SetBranchAddress("times",times)
-nt.SetBranchAddress("voltages",voltages)
-b_area = nt.Branch("area", area, "area/D")
-b_offset = nt.Branch("offset", offset, "offset/D")
-b_noise = nt.Branch("noise", noise, "noise/D")
-b_raw_max = nt.Branch("raw_max", raw_max, "raw_max/D")
-b_smoothed_max = nt.Branch("smoothed_max", smoothed_max, "smoothed_max/D")
-b_tmax = nt.Branch("tmax", tmax, "tmax/D")
-b_tstart = nt.Branch("tstart", tstart, "tstart/D")
-b_tend = nt.Branch("tend", tend, "tend/D")
-b_thalfmax = nt.Branch("thalfmax", thalfmax, "thalfmax/D")
-b_n_APs = nt.Branch("n_afterpulses", n_APs, "n_afterpulses/i")
-b_AP_time = nt.Branch("afterpulse_time", AP_time, "afterpulse_time[n_afterpulses]/D")
-b_AP_area = nt.Branch("afterpulse_area", AP_area, "afterpulse_area[n_afterpulses]/D")
-b_AP_height = nt.Branch("afterpulse_height", AP_height, "afterpulse_height[n_afterpulses]/D")
-b_AP_lowbound = nt.Branch("afterpulse_lowbound", AP_lowbound, "afterpulse_lowbound[n_afterpulses]/D")
-b_AP_highbound = nt.Branch("afterpulse_highbound", AP_highbound, "afterpulse_highbound[n_afterpulses]/D")
+# the output tree is only made if it's written, since the clone holds a
+# copy of every waveform
+if make_output_tree:
+    if friend_tree:
+        # entry i of the feature tree belongs to entry i of the input
+        nt = r.TTree("Features", "Features")
+    else:
+        nt = t.CloneTree(Nevt)
+    writer = treeio.BranchWriter(nt, scalar_names, [k for k,_ in ap_names], "n_afterpulses", fill_tree=friend_tree)
 
 # template = pickle.load(open("../peak_templates/template_peak_70_75_1GHz.pkl", 'rb'))[::2]
-template = pickle.load(open("../peak_templates/template_peak_r7725_400_550_1GHz.pkl", 'rb'))[::1]
+template_file = "../peak_templates/template_peak_r7725_400_550_1GHz.pkl"
+template = pickle.load(open(template_file, 'rb'))[::1]
 template /= np.sum(template)
 
-baseline = pickle.load(open("scripts/baseline_pickles/{0}.pkl".format(bn), 'rb'))
 
-for ievt in range(Nevt):
-# for i in range(10000):
-    nt.GetEntry(ievt)
-    if ievt%1000==0:
-        print "iEvt:", ievt
+if make_output_tree and friend_tree:
+    nt.GetUserInfo().Add(r.TNamed("input", sys.argv[1].split("/")[-1]))
+    nt.GetUserInfo().Add(r.TParameter(float)("t0", t0))
+    nt.GetUserInfo().Add(r.TParameter(float)("minamp", minamp))
+    nt.GetUserInfo().Add(r.TNamed("template", template_file.split("/")[-1]))
 
+def processEvent(ievt, times, voltages):
+    # fill the output buffers for one event, and return its offset-subtracted
+    # waveform and convolution with the template (None if it's skipped)
     vs = -voltages
 
     i0 = np.argmax(times > t0)
@@ -108,7 +121,10 @@ for ievt in range(Nevt):
     tend[0] = times[iend]
     if tstart[0]<30:
         print "WARNING: tstart shouldn't be this low! {0} {1}".format(tstart[0], ievt)
-        continue
+        # still fill, so that the entries stay lined up with the input
+        for x in [area, raw_max, smoothed_max, tmax, thalfmax]:
+            x[0] = -999
+        return None
     if tstart[0]>300:
         raise Exception("tstart shouldn't be this high! {0} {1}".format(tstart[0], ievt))
     # if tend[0]>450:
@@ -135,73 +151,184 @@ for ievt in range(Nevt):
     smoothed_max[0] = cmax
     tmax[0] = convolved_time[icmax]
 
-    peaks = findAPs(times, vs, 0, noise[0], template, tstart[0], tend[0], convolved=convolved, baseline=baseline, remove_neg_spikes=True)
-    n_APs[0] = len(peaks)
-    for i in range(len(peaks)):
-        idx = peaks[i][0]
-        end1, end2 = peaks[i][1]
-        parea = peaks[i][2]
-
-        AP_time[i] = times[idx]
-        AP_area[i] = parea
-        AP_height[i] = vs[idx]
-        AP_lowbound[i] = times[end1]
-        AP_highbound[i] = times[end2]
-
-    if ievt < plotFirst:
-        plt.clf()
-        plt.plot(times,vs+offset[0],color="red")
-        plt.axvline(tstart,ls="dashed",color="black")
-        plt.axvline(tend,ls="dashed",color="black")
-        # plt.axhspan(offset[0]-noise[0],offset[0]+noise[0],color='red',alpha=0.3)
-        # plt.axhline(offset[0],ls="dashed",color="black")
-        # plt.axhline(offset[0]-noise[0],ls="dashed",color="black",lw=1.2)
-        # plt.axhline(offset[0]+noise[0],ls="dashed",color="black",lw=1.2)
-        plt.plot(times, baseline+offset[0], 'k--')
-        plt.plot(times, baseline+offset[0]+noise[0], 'k--')
-        plt.plot(times, baseline+offset[0]-noise[0], 'k--')
-        plt.fill_between(times, baseline+offset[0]+noise[0], baseline+offset[0]-noise[0], color='r', alpha=0.3)
-        plt.plot(convolved_time, convolved+offset[0], 'b-', linewidth=2)
-        plt.plot(times[:template.size], template*75+offset[0], 'g-', linewidth=2)
-        plt.xlim(0,times[-1])
-        plt.xlabel('Time (ns)')
-        # plt.ylim(-5,100)
-        plt.ylim(-5,25)
-        plt.ylabel('Vout (mV)')
-
-        plt.grid(True)
-        plt.title("waveform{0:05d}".format(ievt))
-        inds = [p[0] for p in peaks]
-        plt.plot(times[inds],vs[inds]+offset[0],"x",markersize=10,markeredgewidth=3,color='Blue',alpha=0.5)
-
-        for j in range(len(peaks)):
-            end1, end2 = peaks[j][1]
-            ypos = np.amax(vs[end1:end2]) + offset[0]
-            ypos = min(ypos, 22.5)
-            plt.text(np.mean([times[end1],times[end2]]), ypos+0.4, "{0:.1f}".format(AP_area[j]), fontsize='medium', horizontalalignment='center')
-            plt.fill_between(times[end1:end2+1],baseline[end1:end2+1]+offset[0],[ypos]*(end2-end1+1),color="k",alpha=0.2)
-            
-
-        plt.savefig(outdir+"/wavform{0:05d}.png".format(ievt))
-
-    b_area.Fill()
-    b_offset.Fill()
-    b_noise.Fill()
-    b_raw_max.Fill()
-    b_smoothed_max.Fill()
-    b_tmax.Fill()
-    b_tstart.Fill()
-    b_tend.Fill()
-    b_thalfmax.Fill()
-    b_n_APs.Fill()
-    b_AP_time.Fill()
-    b_AP_area.Fill()
-    b_AP_height.Fill()
-    b_AP_lowbound.Fill()
-    b_AP_highbound.Fill()
+    return vs, convolved
+
+def plotEvent(ievt, times, vs, vals, convolved, aps, lo, hi):
+    offset, noise = vals["offset"], vals["noise"]
+    imax = np.argmax(template)
+    convolved_time = times[imax:imax+convolved.size]
+    plt.clf()
+    plt.plot(times,vs+offset,color="red")
+    plt.axvline(vals["tstart"],ls="dashed",color="black")
+    plt.axvline(vals["tend"],ls="dashed",color="black")
+    # plt.axhspan(offset-noise,offset+noise,color='red',alpha=0.3)
+    # plt.axhline(offset,ls="dashed",color="black")
+    # plt.axhline(offset-noise,ls="dashed",color="black",lw=1.2)
+    # plt.axhline(offset+noise,ls="dashed",color="black",lw=1.2)
+    plt.plot(times, baseline+offset, 'k--')
+    plt.plot(times, baseline+offset+noise, 'k--')
+    plt.plot(times, baseline+offset-noise, 'k--')
+    plt.fill_between(times, baseline+offset+noise, baseline+offset-noise, color='r', alpha=0.3)
+    plt.plot(convolved_time, convolved+offset, 'b-', linewidth=2)
+    plt.plot(times[:template.size], template*75+offset, 'g-', linewidth=2)
+    plt.xlim(0,times[-1])
+    plt.xlabel('Time (ns)')
+    # plt.ylim(-5,100)
+    plt.ylim(-5,25)
+    plt.ylabel('Vout (mV)')
+
+    plt.grid(True)
+    plt.title("waveform{0:05d}".format(ievt))
+    inds = aps["index"][lo:hi]
+    plt.plot(times[inds],vs[inds]+offset,"x",markersize=10,markeredgewidth=3,color='Blue',alpha=0.5)
+
+    for j in range(lo, hi):
+        end1, end2 = aps["end1"][j], aps["end2"][j]
+        ypos = np.amax(vs[end1:end2]) + offset
+        ypos = min(ypos, 22.5)
+        plt.text(np.mean([times[end1],times[end2]]), ypos+0.4, "{0:.1f}".format(aps["area"][j]), fontsize='medium', horizontalalignment='center')
+        plt.fill_between(times[end1:end2+1],baseline[end1:end2+1]+offset,[ypos]*(end2-end1+1),color="k",alpha=0.2)
+
+    plt.savefig(outdir+"/wavform{0:05d}.png".format(ievt))
+
+def processRange(rng):
+    # process input entries [start, stop), reading them with a separate
+    # handle on the input so that this can run in a worker process.
+    # returns the per-event quantities as [N] arrays keyed by scalar_names,
+    # and the afterpulses of all of the events from findAPsBatch
+    start, stop = rng
+    print "iEvt:", start
+    fin = r.TFile(sys.argv[1])
+    d = treeio.readBranches(fin.Get("Events"), ["times", "voltages"], start, stop)
+    fin.Close()
+
+    n = stop-start
+    vals = np.zeros((n, len(scalars)))
+    vs = np.zeros(d["voltages"].shape)
+    convolved = np.zeros((n, d["voltages"].shape[1]-template.size+1))
+    good = np.zeros(n, dtype=bool)
+    for i in range(n):
+        res = processEvent(start+i, d["times"][i], d["voltages"][i])
+        vals[i] = [x[0] for x in scalars]
+        if res is not None:
+            good[i] = True
+            vs[i], convolved[i] = res
+    vals = dict(zip(scalar_names, vals.T))
+
+    # the afterpulses of the events that weren't skipped, indexed back to
+    # all of the events in the range
+    aps = findAPsBatch(d["times"][good], vs[good], 0, vals["noise"][good], template, vals["tend"][good],
+                       convolved=convolved[good], baseline=baseline, remove_neg_spikes=True)
+    aps["event"] = np.nonzero(good)[0][aps["event"]]
+    aps["offsets"] = np.concatenate([[0], np.cumsum(np.bincount(aps["event"], minlength=n))])
+
+    for i in range(min(n, plotFirst-start)):
+        if good[i]:
+            plotEvent(start+i, d["times"][i], vs[i], {k: v[i] for k,v in vals.items()}, convolved[i],
+                      aps, aps["offsets"][i], aps["offsets"][i+1])
+
+    spectra = None
+    if accumulate:
+        spectra = APSpectra()
+        spectra.fill(vals["tmax"], vals["area"], aps, good)
+
+    return vals, aps, spectra
+
+def baselineRange(rng):
+    # baseline estimate from input entries [start, stop), with the offsets
+    # found as in processEvent
+    start, stop = rng
+    print "Baseline iEvt:", start
+    fin = r.TFile(sys.argv[1])
+    d = treeio.readBranches(fin.Get("Events"), ["times", "voltages"], start, stop)
+    fin.Close()
+    vs = -d["voltages"]
+    for i in range(vs.shape[0]):
+        i0 = np.argmax(d["times"][i] > t0)
+        vs[i] -= np.median(vs[i][30:i0*3/4])
+    est = BaselineEstimator(vs.shape[1])
+    est.fill(vs)
+    return est
+
+def baselineRanges(rngs):
+    # baselineRange over several ranges, merged as it goes, so that a
+    # worker holds at most two estimators at a time
+    est = None
+    for rng in rngs:
+        e = baselineRange(rng)
+        if est is None:
+            est = e
+        else:
+            est.add(e)
+    return est
+
+def makeBaseline(nsample):
+    # run baselineRange over blocks of up to chunkSize events spread evenly
+    # through the run, and merge them. each worker of the pool merges its
+    # share of the blocks, so only one estimator per worker comes back
+    if nsample <= 0 or nsample >= Nevt:
+        ranges = [(i, min(i+chunkSize, Nevt)) for i in range(0, Nevt, chunkSize)]
+    else:
+        size = min(chunkSize, nsample)
+        nblocks = (nsample+size-1) / size
+        starts = np.unique(np.linspace(0, Nevt-size, nblocks).astype(int))
+        ranges = [(s, s+size) for s in starts]
+    if njobs > 1:
+        pool = multiprocessing.Pool(njobs)
+        ests = pool.map(baselineRanges, [ranges[j::njobs] for j in range(njobs) if len(ranges[j::njobs]) > 0])
+        pool.close()
+        pool.join()
+    else:
+        ests = [baselineRanges(ranges)]
+    est = ests[0]
+    for e in ests[1:]:
+        est.add(e)
+    return est.median() if baseline_estimate == "median" else est.mean()
+
+baseline_file = "scripts/baseline_pickles/{0}.pkl".format(bn)
+if os.path.exists(baseline_file):
+    baseline = pickle.load(open(baseline_file, 'rb'))
+else:
+    print "No baseline in {0}, estimating it".format(baseline_file)
+    baseline = makeBaseline(baseline_nsample)
+    if not os.path.exists(os.path.dirname(baseline_file)):
+        os.makedirs(os.path.dirname(baseline_file))
+    pickle.dump(baseline, open(baseline_file, 'wb'))
+
+# the pool is only started now, so that the workers get the baseline
+ranges = [(i, min(i+chunkSize, Nevt)) for i in range(0, Nevt, chunkSize)]
+if njobs > 1:
+    pool = multiprocessing.Pool(njobs)
+    results = pool.imap(processRange, ranges)
+else:
+    results = (processRange(rng) for rng in ranges)
+
+# imap hands back the ranges in order, so the output is the same as
+# for a serial run
+spectra = APSpectra() if accumulate else None
+for vals, aps, spec in results:
+    if make_output_tree:
+        ragged = {k: aps[a] for k,a in ap_names}
+        ragged["offsets"] = aps["offsets"]
+        writer.fill(vals, ragged)
+    if accumulate:
+        spectra.add(spec)
+
+if njobs > 1:
+    pool.close()
+    pool.join()
+
+if accumulate:
+    specname = sys.argv[1].split(".")[0] + "_apspectra.npz"
+    spectra.save(specname)
+    print "Saved afterpulse spectra to:", specname
+    print "  primaries: {0}, afterpulse probability: {1:.4f}, afterpulses per primary: {2:.4f}".format(
+        spectra.n_primaries(), spectra.probability(), spectra.aps_per_primary()[0])
+    print "  delay: {0:.1f} +- {1:.1f} ns, area: {2:.2f} +- {3:.2f}".format(
+        spectra.delay_moments.mean(), spectra.delay_moments.std(), spectra.area_moments.mean(), spectra.area_moments.std())
 
 if make_output_tree:
-    nt.Write("Events",r.TObject.kWriteDelete)
+    nt.Write(nt.GetName(),r.TObject.kWriteDelete)
     fout.Close()
 
 f.Close()
@@ -0,0 +1,287 @@
+## read binary files output from the DRS scope
+##
+## the file starts with a TIME block (bin widths for every channel),
+## after which every event is a fixed-size record. the TIME block is
+## parsed once and the events are then read as numpy record arrays
+
+import os
+import numpy as np
+
+N_BINS = 1024 # number of timing bins per channel
+
+def readHeader(fid, verbose=True):
+    # parse the DRS2/TIME/B#/C00x preamble of an open .dat file.
+    # returns a dict with the board ids, the channels in the file,
+    # their bin widths (shape [n_chan, N_BINS]) and the byte offset
+    # of the first event record. fid is left pointing at that record
+
+    fhdr = fid.read(4)
+    if fhdr != b"DRS2":
+        raise Exception("unrecognized header {0}".format(fhdr))
+
+    thdr = fid.read(4)
+    if thdr != b"TIME":
+        raise Exception("unrecognized time header {0}".format(thdr))
+
+    # get the boards in file
+    board_ids = []
+    channels = []
+    bin_widths = []
+    while True:
+        if fid.read(2) != b"B#":
+            fid.seek(-2, 1)
+            break
+        board_ids.append(int(np.frombuffer(fid.read(2), dtype="<u2")[0]))
+        if verbose:
+            print("Found Board #"+str(board_ids[-1]))
+
+        nfound = 0
+        while True:
+            chdr = fid.read(4)
+            if chdr[:3] != b"C00":
+                fid.seek(-len(chdr), 1)
+                break
+            cnum = int(chdr[3:].decode("utf-8"))
+            if verbose:
+                print("  Found channel #"+str(cnum))
+            channels.append(cnum)
+            bin_widths.append(np.frombuffer(fid.read(4*N_BINS), dtype="<f4"))
+            nfound += 1
+
+        if nfound==0:
+            raise Exception("Board #{0} doesn't have any channels!".format(board_ids[-1]))
+
+    if len(board_ids)==0:
+        raise Exception("didn't find any valid boards!")
+
+    if len(board_ids) > 1:
+        raise Exception("only support one board. Found {0} in file.".format(len(board_ids)))
+
+    return {"board_ids": board_ids,
+            "channels": channels,
+            "bin_widths": np.array(bin_widths, dtype=float),
+            "data_offset": fid.tell()}
+
+def eventDtype(channels):
+    # numpy dtype of a single event record for the given channels
+    # (all of the channels in the file, in file order)
+    fields = [("ehdr", "S4"),
+              ("serial", "<u4"),
+              ("date", "<u2", (7,)),
+              ("range", "<u2"),
+              ("bhdr", "S2"),
+              ("board", "<u2"),
+              ("thdr", "S2"),
+              ("trig_cell", "<u2")]
+    for c in channels:
+        fields += [("chdr_{0}".format(c), "S4"),
+                   ("scaler_{0}".format(c), "<u4"),
+                   ("adc_{0}".format(c), "<u2", (N_BINS,))]
+    return np.dtype(fields)
+
+def readEvents(fid, channels, count=-1):
+    # read up to count complete event records from the current position
+    # of fid (all remaining events if count<0). a truncated record at the
+    # end of the file is not returned, and fid is left at its start
+    dtype = eventDtype(channels)
+    if count < 0:
+        data = fid.read()
+    else:
+        data = fid.read(count*dtype.itemsize)
+    nfull = len(data) // dtype.itemsize
+    if nfull*dtype.itemsize != len(data):
+        fid.seek(nfull*dtype.itemsize - len(data), 1)
+    evts = np.frombuffer(data, dtype=dtype, count=nfull)
+    checkEvents(evts, channels)
+    return evts
+
+def checkEvents(evts, channels):
+    # make sure all of the record markers are where they should be
+    if not np.all(evts["ehdr"] == b"EHDR"):
+        raise Exception("Bad event header!")
+    for c in channels:
+        if not np.all(evts["chdr_{0}".format(c)] == "C00{0}".format(c).encode("utf-8")):
+            raise Exception("bad event data!")
+
+def getTimestamps(dates):
+    # seconds since the epoch for an [N,7] array of DRS dates
+    # (year, month, day, hour, minute, second, millisecond).
+    # gives the same values as building a datetime for each event
+    dates = np.asarray(dates, dtype=np.int64)
+    months = (dates[:,0]-1970)*12 + dates[:,1]-1
+    days = months.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64) + dates[:,2]-1
+    secs = ((days*24 + dates[:,3])*60 + dates[:,4])*60 + dates[:,5]
+    return (secs*1000000 + dates[:,6]*1000) / 1e6
+
+def getVoltages(adc, rangeCtr):
+    # convert raw [N,N_BINS] ADC counts to millivolts
+    return adc/65535. * 1000 - 500 + np.asarray(rangeCtr)[:,np.newaxis]
+
+def getTimes(bin_widths, trig_cells, ichans):
+    # calibrated time axes, shape [N, len(ichans), N_BINS], for events with
+    # the given trigger cells. ichans are indices into bin_widths. every
+    # channel is shifted so that its trigger cell lines up in time with
+    # that of the first of ichans in file order
+    trig_cells = np.asarray(trig_cells, dtype=np.int64)
+    idx = (trig_cells[:,np.newaxis] + np.arange(N_BINS-1)) % N_BINS
+    iref = (N_BINS - trig_cells) % N_BINS
+    ievt = np.arange(trig_cells.size)
+
+    times = np.zeros((trig_cells.size, len(ichans), N_BINS))
+    for j,ic in enumerate(ichans):
+        times[:,j,1:] = np.cumsum(bin_widths[ic][idx], axis=1)
+
+    j0 = int(np.argmin(ichans))
+    time0 = times[ievt,j0,iref]
+    for j in range(len(ichans)):
+        if j != j0:
+            times[:,j,:] -= (times[ievt,j,iref] - time0)[:,np.newaxis]
+    return times
+
+def getTimeTable(hdr, channels):
+    # lookup table of calibrated time axes for every trigger cell, shape
+    # [N_BINS, nch, N_BINS], so that the times of a batch of events are
+    # just table[trig_cells]. built once per set of channels and kept in hdr
+    key = tuple(channels)
+    tables = hdr.setdefault("time_tables", {})
+    if key not in tables:
+        ichans = [hdr["channels"].index(c) for c in channels]
+        tables[key] = getTimes(hdr["bin_widths"], np.arange(N_BINS), ichans)
+    return tables[key]
+
+def getSampleRate(hdr, channels, trig_cell_counts):
+    # mean sampling rate (GHz) over events with the given histogram of
+    # trigger cells. the time axis of an event spans every bin except the
+    # one just before the trigger cell, so this is exact rather than an
+    # average built up event by event
+    counts = np.asarray(trig_cell_counts, dtype=float)
+    nevt = np.sum(counts)
+    bw = hdr["bin_widths"][[hdr["channels"].index(c) for c in channels]]
+    span = nevt*np.sum(bw) - np.sum(np.dot(np.roll(bw, 1, axis=1), counts))
+    return nevt*len(channels)*(N_BINS-1) / span
+
+def calibrate(hdr, channels, trig_cells, rangeCtr, adcs, polarity=1):
+    # calibrated times and voltages, both [N,nch,N_BINS], from the raw
+    # trigger cells, range centers and ADC counts (a list of [N,N_BINS]
+    # arrays in the order of channels)
+    times = getTimeTable(hdr, channels)[np.asarray(trig_cells, dtype=int)]
+    voltages = np.empty(times.shape)
+    for j in range(len(channels)):
+        voltages[:,j,:] = getVoltages(adcs[j], rangeCtr) * polarity
+    return times, voltages
+
+def decodeEvents(evts, hdr, channels, polarity=1):
+    # turn a record array from readEvents into
+    # (timestamps, trig_cells, times[N,nch,N_BINS], voltages[N,nch,N_BINS])
+    # for the requested channels
+    timestamps = getTimestamps(evts["date"])
+    trig_cells = evts["trig_cell"].astype(int)
+    adcs = [evts["adc_{0}".format(c)] for c in channels]
+    times, voltages = calibrate(hdr, channels, trig_cells, evts["range"], adcs, polarity)
+    return timestamps, trig_cells, times, voltages
+
+def iterEvents(fname, batch_size=1000, channels=None, polarity=1, verbose=False):
+    # generator over the events in a DRS .dat file, yielding batches of up
+    # to batch_size events as returned by decodeEvents. channels defaults
+    # to every channel in the file. only one batch is in memory at a time
+    with open(fname, 'rb') as fid:
+        hdr = readHeader(fid, verbose)
+        if channels is None:
+            channels = hdr["channels"]
+        for c in channels:
+            if c not in hdr["channels"]:
+                raise Exception("set to read channel {0}, but it isn't in the file!".format(c))
+
+        while True:
+            evts = readEvents(fid, hdr["channels"], batch_size)
+            if evts.size == 0:
+                break
+            yield decodeEvents(evts, hdr, channels, polarity)
+
+def getIndexName(fname):
+    return fname + ".idx.npz"
+
+def buildIndex(fname, batch_size=10000, verbose=False):
+    # build (or bring up to date) the sidecar index of a .dat file, holding
+    # the byte offset, trigger cell and timestamp of every event. the index
+    # is cached next to the input and checked against its size and mtime.
+    # if the file has only grown since, just the new events are indexed
+    iname = getIndexName(fname)
+    st = os.stat(fname)
+
+    idx = None
+    if os.path.exists(iname):
+        try:
+            idx = dict(np.load(iname))
+        except Exception:
+            idx = None
+    if idx is not None and idx["size"] == st.st_size and idx["mtime"] == st.st_mtime:
+        return idx
+
+    with open(fname, 'rb') as fid:
+        hdr = readHeader(fid, verbose)
+        evt_size = eventDtype(hdr["channels"]).itemsize
+
+        offsets = [np.zeros(0, dtype=np.int64)]
+        trig_cells = [np.zeros(0, dtype=np.uint16)]
+        timestamps = [np.zeros(0)]
+        # keep the old entries only if the file has just had events appended
+        if idx is not None and st.st_size >= idx["size"] and \
+                list(idx["channels"]) == hdr["channels"] and idx["data_offset"] == hdr["data_offset"] and \
+                idx["offsets"].size > 0:
+            fid.seek(idx["offsets"][-1])
+            last = readEvents(fid, hdr["channels"], 1)
+            if last.size == 0 or last["trig_cell"][0] != idx["trig_cells"][-1] or \
+                    getTimestamps(last["date"])[0] != idx["timestamps"][-1]:
+                idx = None
+            fid.seek(hdr["data_offset"])
+        else:
+            idx = None
+        if idx is not None:
+            offsets.append(idx["offsets"])
+            trig_cells.append(idx["trig_cells"])
+            timestamps.append(idx["timestamps"])
+            fid.seek(hdr["data_offset"] + idx["offsets"].size*evt_size)
+
+        while True:
+            start = fid.tell()
+            evts = readEvents(fid, hdr["channels"], batch_size)
+            if evts.size == 0:
+                break
+            offsets.append(start + evt_size*np.arange(evts.size, dtype=np.int64))
+            trig_cells.append(evts["trig_cell"].copy())
+            timestamps.append(getTimestamps(evts["date"]))
+
+    idx = {"offsets": np.concatenate(offsets),
+           "trig_cells": np.concatenate(trig_cells),
+           "timestamps": np.concatenate(timestamps),
+           "channels": np.array(hdr["channels"]),
+           "data_offset": hdr["data_offset"],
+           "evt_size": evt_size,
+           "size": st.st_size,
+           "mtime": st.st_mtime}
+    # write to a temporary file first so that a reader never sees half an index
+    with open(iname + ".tmp", 'wb') as fout:
+        np.savez(fout, **idx)
+    os.rename(iname + ".tmp", iname)
+    return idx
+
+def readEventRange(fname, start, stop=None, channels=None, polarity=1, idx=None):
+    # decode events [start, stop) of a .dat file, as returned by decodeEvents,
+    # by seeking straight to them with the sidecar index
+    if idx is None:
+        idx = buildIndex(fname)
+    nevt = idx["offsets"].size
+    if stop is None:
+        stop = start+1
+    start, stop = max(0, start), min(stop, nevt)
+    with open(fname, 'rb') as fid:
+        hdr = readHeader(fid, verbose=False)
+        if channels is None:
+            channels = hdr["channels"]
+        if stop <= start:
+            evts = np.zeros(0, dtype=eventDtype(hdr["channels"]))
+        else:
+            fid.seek(idx["offsets"][start])
+            evts = readEvents(fid, hdr["channels"], stop-start)
+    return decodeEvents(evts, hdr, channels, polarity)
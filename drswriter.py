@@ -0,0 +1,210 @@
+#! /usr/bin/env python
+
+## write synthetic DRS .dat files in the format read by drsreader.py (and so
+## processBinary.py): the DRS2/TIME header with the bin widths of every
+## channel, then one fixed-size record per event. events are made and
+## written a batch at a time, so files of any size can be generated with
+## little memory. the waveforms are flat gaussian noise, or simulated PMT
+## pulses from photon_template_generator/eventsim.py
+
+import os
+import sys
+import time
+import argparse
+import collections
+import multiprocessing
+import numpy as np
+import drsreader
+
+N_BINS = drsreader.N_BINS
+
+def writeHeader(fid, board, channels, bin_widths):
+    # the DRS2/TIME/B#/C00x preamble, with bin_widths [len(channels),N_BINS]
+    # in the order of channels
+    fid.write(b"DRS2")
+    fid.write(b"TIME")
+    fid.write(b"B#" + np.array([board], dtype="<u2").tobytes())
+    for c,bw in zip(channels, bin_widths):
+        fid.write("C{0:03d}".format(c).encode("utf-8"))
+        fid.write(np.asarray(bw, dtype="<f4").tobytes())
+
+def getDates(timestamps):
+    # [N,7] DRS dates (year, month, day, hour, minute, second, millisecond)
+    # for seconds since the epoch, the inverse of drsreader.getTimestamps
+    ms = np.round(np.asarray(timestamps, dtype=float)*1000).astype(np.int64).astype("datetime64[ms]")
+    days = ms.astype("datetime64[D]")
+    months = ms.astype("datetime64[M]")
+    msday = (ms - days).astype(np.int64)
+    dates = np.empty((ms.size, 7), dtype=np.int64)
+    dates[:,0] = ms.astype("datetime64[Y]").astype(np.int64) + 1970
+    dates[:,1] = months.astype(np.int64) % 12 + 1
+    dates[:,2] = (days - months.astype("datetime64[D]")).astype(np.int64) + 1
+    dates[:,3] = msday // 3600000
+    dates[:,4] = msday // 60000 % 60
+    dates[:,5] = msday // 1000 % 60
+    dates[:,6] = msday % 1000
+    return dates
+
+def getADC(voltages, rangeCtr):
+    # raw ADC counts for voltages in millivolts, the inverse of
+    # drsreader.getVoltages (rounded, and clipped to the range of the ADC)
+    adc = (np.asarray(voltages) + 500 - rangeCtr) * (65535/1000.)
+    return np.clip(np.round(adc), 0, 65535).astype("<u2")
+
+def makeEvents(serials, timestamps, trig_cells, voltages, channels, board, rangeCtr=0):
+    # a record array (drsreader.eventDtype) of events with the given serial
+    # numbers, timestamps, trigger cells and voltages [N,len(channels),N_BINS]
+    evts = np.zeros(len(serials), dtype=drsreader.eventDtype(channels))
+    evts["ehdr"] = b"EHDR"
+    evts["serial"] = serials
+    evts["date"] = getDates(timestamps)
+    evts["range"] = rangeCtr
+    evts["bhdr"] = b"B#"
+    evts["board"] = board
+    evts["thdr"] = b"T#"
+    evts["trig_cell"] = trig_cells
+    for j,c in enumerate(channels):
+        evts["chdr_{0}".format(c)] = "C{0:03d}".format(c).encode("utf-8")
+        evts["adc_{0}".format(c)] = getADC(voltages[:,j], rangeCtr)
+    return evts
+
+class DRSWriter(object):
+    # writes a .dat file with one board, holding channels with bin widths
+    # [len(channels),N_BINS] (even 0.5 ns bins if None). events are added
+    # with write(), numbered from 1
+    def __init__(self, fname, channels, bin_widths=None, board=0, rangeCtr=0):
+        self.channels = list(channels)
+        if bin_widths is None:
+            bin_widths = np.full((len(self.channels), N_BINS), 0.5)
+        self.board = board
+        self.rangeCtr = rangeCtr
+        self.nevt = 0
+        self.fid = open(fname, 'wb')
+        writeHeader(self.fid, board, self.channels, bin_widths)
+
+    def write(self, trig_cells, voltages, timestamps):
+        # add events with trigger cells and timestamps [N] and voltages
+        # [N,len(channels),N_BINS] (as returned by drsreader.decodeEvents)
+        n = len(trig_cells)
+        serials = np.arange(self.nevt+1, self.nevt+n+1)
+        self.writeEvents(makeEvents(serials, timestamps, trig_cells, voltages, self.channels, self.board, self.rangeCtr))
+
+    def writeEvents(self, evts):
+        # add a record array of events from makeEvents
+        self.fid.write(evts.tobytes())
+        self.nevt += evts.size
+
+    def close(self):
+        self.fid.close()
+
+def readTimeBlock(fname, channels):
+    # bin widths [len(channels),N_BINS] and board number from the TIME block
+    # of a .dat file: the bin widths of the same channel where it's in the
+    # file, else those of its first channel. (eventsim.getBinWidths gives the
+    # bin widths of a single channel that must be in the file)
+    with open(fname, 'rb') as fid:
+        hdr = drsreader.readHeader(fid, verbose=False)
+    ichans = [hdr["channels"].index(c) if c in hdr["channels"] else 0 for c in channels]
+    return hdr["bin_widths"][ichans], hdr["board_ids"][0]
+
+_worker_state = {}
+def _initWorker(args, bin_widths):
+    # the simulators, if any, are set up once per process
+    _worker_state["args"] = args
+    if args.content == "pulses":
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "photon_template_generator"))
+        import eventsim
+        _worker_state["sims"] = [eventsim.EventSimulator(args.model, bw, seed=args.seed, mean_npe=args.npe, t0=args.t0,
+                                                         noise=args.noise, offset=args.offset, ap_rate=args.ap_rate)
+                                 for bw in bin_widths]
+
+def _makeBlock(block):
+    # the event records of block (iblock, first event, number of events),
+    # from the iblock'th stream of the seed, so a file only depends on the
+    # seed and batch size and not on the number of workers
+    iblock, istart, n = block
+    args = _worker_state["args"]
+    rng = np.random.default_rng(np.random.SeedSequence(args.seed, spawn_key=(iblock,)))
+    trig_cells = rng.integers(0, N_BINS, n)
+    if args.content == "pulses":
+        voltages = np.stack([sim.generate(n, rng, trig_cells)["voltages"] for sim in _worker_state["sims"]], axis=1)
+    else:
+        voltages = args.offset + args.noise*rng.standard_normal((n, len(args.chans), N_BINS))
+    timestamps = args.start + np.arange(istart, istart+n) / args.rate
+    return makeEvents(np.arange(istart+1, istart+n+1), timestamps, trig_cells, voltages, args.chans, args.board)
+
+def iterBlocks(blocks, args, bin_widths, njobs=1):
+    # the event records of blocks in order. with njobs>1 they're made in
+    # worker processes, with at most 2*njobs blocks in flight at once (as in
+    # processBinary.iterChunks), so the memory used doesn't grow when the
+    # disk is slower than the workers
+    if njobs <= 1:
+        _initWorker(args, bin_widths)
+        for block in blocks:
+            yield _makeBlock(block)
+        return
+
+    pool = multiprocessing.Pool(njobs, _initWorker, (args, bin_widths))
+    pending = collections.deque()
+    try:
+        for block in blocks:
+            pending.append(pool.apply_async(_makeBlock, (block,)))
+            if len(pending) >= 2*njobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic DRS .dat file")
+    parser.add_argument("output", help="output .dat file")
+    parser.add_argument("-n", "--nevents", type=int, default=1000, help="number of events")
+    parser.add_argument("-c", "--chans", type=int, nargs="+", default=[1,2], help="channels to write")
+    parser.add_argument("--content", choices=["noise", "pulses"], default="noise",
+                        help="flat gaussian noise, or simulated PMT pulses on top of it (needs ROOT)")
+    parser.add_argument("--noise", type=float, default=0.38, help="rms of the baseline noise (mV)")
+    parser.add_argument("--offset", type=float, default=0., help="baseline offset (mV)")
+    parser.add_argument("--npe", type=float, default=1.0, help="mean number of photoelectrons per event")
+    parser.add_argument("--t0", type=float, default=260., help="mean time of the pulses (ns)")
+    parser.add_argument("--ap-rate", type=float, default=0., help="mean number of afterpulses per photoelectron")
+    parser.add_argument("--model", default="r878", help="PMT model of the pulses")
+    parser.add_argument("--dat", default=None, help="take the bin widths and board number from this .dat file")
+    parser.add_argument("--board", type=int, default=None, help="board number")
+    parser.add_argument("--rate", type=float, default=300., help="trigger rate (Hz) for the event timestamps")
+    parser.add_argument("--start", type=float, default=None, help="timestamp of the first event (default now)")
+    parser.add_argument("--seed", type=int, default=None, help="random seed")
+    parser.add_argument("--batch-size", type=int, default=10000, help="events made and written at a time")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+                        help="number of worker processes")
+    args = parser.parse_args(argv)
+
+    if args.dat:
+        bin_widths, board = readTimeBlock(args.dat, args.chans)
+    else:
+        bin_widths, board = np.full((len(args.chans), N_BINS), 0.5), 0
+    if args.board is None:
+        args.board = board
+    if args.start is None:
+        args.start = float(int(time.time()))
+    args.seed = np.random.SeedSequence(args.seed).entropy
+    print("Writing {0} events to {1} (seed {2})".format(args.nevents, args.output, args.seed))
+
+    blocks = [(i, i*args.batch_size, min(args.batch_size, args.nevents-i*args.batch_size))
+              for i in range((args.nevents + args.batch_size - 1) // args.batch_size)]
+    njobs = max(1, min(args.jobs, len(blocks)))
+
+    t0 = time.time()
+    writer = DRSWriter(args.output, args.chans, bin_widths, args.board)
+    for evts in iterBlocks(blocks, args, bin_widths, njobs):
+        writer.writeEvents(evts)
+        print("iEvt: {0}".format(writer.nevt))
+    writer.close()
+
+    dt = time.time() - t0
+    size = os.path.getsize(args.output) / 1024.**2
+    print("Wrote {0} events ({1:.1f} MB) in {2:.1f} s ({3:.1f} MB/s)".format(writer.nevt, size, dt, size/max(dt, 1e-9)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+## pulse features (offset, noise, area and optionally template-matched
+## timing) for batches of waveforms, computed the same way as in
+## postprocess.py
+
+import os
+import hashlib
+import numpy as np
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+FEATURE_NAMES = ["area", "offset", "noise", "smoothed_max", "tmax", "thalfmax", "fwhm"]
+
+# features that are computed (and cached) together, since they depend on
+# the same parameters
+FEATURE_GROUPS = {"baseline": ["offset", "noise"],
+                  "area": ["area"],
+                  "timing": ["smoothed_max", "tmax", "thalfmax", "fwhm"]}
+
+def loadTemplate(fname, stride=1):
+    # load a peak template pickle, keeping every stride'th sample,
+    # normalized to unit sum
+    with open(fname, 'rb') as fid:
+        try:
+            template = pickle.load(fid, encoding="latin1")
+        except TypeError:
+            template = pickle.load(fid)
+    template = np.array(template, dtype=float)[::stride]
+    return template / np.sum(template)
+
+# templates with more samples than this are convolved with FFTs, which
+# are faster from about half a dozen samples on
+FFT_MIN_TAPS = 6
+
+def convolveBatch(vs, template, method="auto"):
+    # np.convolve(v, template[::-1], mode='valid') for every row v of vs.
+    # "direct" sums shifted copies of the rows, one per template sample,
+    # and "fft" multiplies the spectra, which is faster unless the
+    # template is very short
+    nevt, nsamp = vs.shape
+    ntmp = template.size
+    nout = nsamp - ntmp + 1
+    if method == "auto":
+        method = "fft" if ntmp > FFT_MIN_TAPS else "direct"
+    if method == "direct":
+        out = np.zeros((nevt, nout))
+        for j in range(ntmp):
+            out += template[j] * vs[:,j:j+nout]
+        return out
+    if method == "fft":
+        nfft = 1 << int(np.ceil(np.log2(nsamp + ntmp - 1)))
+        spec = np.fft.rfft(vs, nfft, axis=1) * np.fft.rfft(template[::-1], nfft)
+        return np.fft.irfft(spec, nfft, axis=1)[:,ntmp-1:nsamp]
+    raise Exception("unknown convolution method {0}".format(method))
+
+def getTiming(times, vs, template, tstart, tend, method="auto"):
+    # convolve offset-subtracted [N,1024] waveforms with the template and
+    # find the smoothed maximum, its time, the leading-edge half-max time
+    # and the width at half max, for the whole batch at once. -999 where
+    # they can't be determined. returns a dict of [N] arrays.
+    # only the part of the convolution in each row's pulse window (plus a
+    # sample either side) is computed: columns o+k, k < nwin, of the full
+    # convolution, from samples o+k .. o+k+ntmp-1 of the waveform
+    nevt, nsamp = vs.shape
+    ntmp = template.size
+    ncon = nsamp - ntmp + 1
+    rows = np.arange(nevt)
+    imax = np.argmax(template)
+    convolved_time = times[:,imax:imax+ncon]
+    icstart = np.argmax(convolved_time > tstart + times[:,:1], axis=1)
+    icend = np.argmax(convolved_time > tend + times[:,:1], axis=1)
+    good = icend > icstart
+
+    o = np.maximum(icstart-1, 0)
+    nwin = max(int(np.amax(np.minimum(icend+2, ncon) - o)) if nevt > 0 else 1, 1)
+    seg = vs[rows[:,np.newaxis], np.minimum(o[:,np.newaxis] + np.arange(nwin + ntmp - 1), nsamp-1)]
+    convolved = convolveBatch(seg, template, method)
+    cols = o[:,np.newaxis] + np.arange(nwin)
+
+    def conv(i):
+        return convolved[rows, np.clip(i - o, 0, nwin-1)]
+
+    inwin = (cols >= icstart[:,np.newaxis]) & (cols < icend[:,np.newaxis])
+    icmax = o + np.argmax(np.where(inwin, convolved, -np.inf), axis=1)
+    cmax = conv(icmax)
+    half = cmax/2
+    below = convolved <= half[:,np.newaxis]
+
+    # walking left from the max: the last sample at or below half max
+    # after icstart, or icstart itself
+    left = below & (cols > icstart[:,np.newaxis]) & (cols <= icmax[:,np.newaxis])
+    ihm = np.where(left.any(axis=1), np.amax(np.where(left, cols, -1), axis=1), icstart)
+    c0, c1 = conv(ihm), conv(np.minimum(ihm+1,ncon-1))
+    t0, t1 = convolved_time[rows,ihm], convolved_time[rows,np.minimum(ihm+1,ncon-1)]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        thalfmax = np.where((cmax < 0.5) | (c0 > half), -999, t0 + (t1-t0)/(c1-c0) * (half - c0))
+
+    # walking right from the max: the first sample at or below half max
+    # before icend, or icend itself
+    right = below & (cols >= icmax[:,np.newaxis]) & (cols < icend[:,np.newaxis])
+    ihm = np.where(right.any(axis=1), o + np.argmax(right, axis=1), icend)
+    c0, c1 = conv(ihm), conv(ihm-1)
+    t0, t1 = convolved_time[rows,ihm], convolved_time[rows,ihm-1]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fwhm = np.where((cmax < 0.5) | (c0 > half) | (thalfmax < 0), -999,
+                        t0 + (t1-t0)/(c1-c0) * (half - c0) - thalfmax)
+
+    out = {"smoothed_max": cmax,
+           "tmax": convolved_time[rows,icmax],
+           "thalfmax": thalfmax,
+           "fwhm": fwhm}
+    # no pulse window to search in
+    for k in out:
+        out[k] = np.where(good, out[k], -999.)
+    return out
+
+def getWindow(times, tstart, tend):
+    # indices of the first samples past tstart and tend (relative to the
+    # first sample) in each row of times, 0 if there are none
+    istart = np.argmax(times > tstart + times[:,:1], axis=1)
+    iend = np.argmax(times > tend + times[:,:1], axis=1)
+    return istart, iend
+
+def rowPercentile(vs, n, q):
+    # np.percentile(vs[i,:n[i]], q) for every row i (linear interpolation),
+    # nan for empty rows
+    nmax = max(int(np.amax(n)), 1) if n.size else 1
+    cols = np.arange(nmax)
+    s = np.sort(np.where(cols < n[:,np.newaxis], vs[:,:nmax], np.inf), axis=1)
+    virt = (n-1) * (q/100.)
+    prev = np.floor(virt).astype(int)
+    gamma = virt - prev
+    prev = np.clip(prev, 0, nmax-1)
+    nxt = np.clip(np.minimum(prev+1, n-1), 0, nmax-1)
+    rows = np.arange(vs.shape[0])
+    a, b = s[rows,prev], s[rows,nxt]
+    # same interpolation as numpy, including the form used for gamma>=0.5
+    with np.errstate(invalid="ignore"):
+        res = np.where(gamma >= 0.5, b - (b-a)*(1-gamma), a + (b-a)*gamma)
+    return np.where(n > 0, res, np.nan)
+
+def computeFeatures(times, vs, tstart, tend, template=None, groups=None):
+    # times and vs are [N,1024], with pulses positive (i.e. the negated
+    # voltages in a processBinary.py output). tstart and tend give the pulse
+    # window relative to the first sample; the offset and noise come from
+    # the first 3/4 of the samples before it. the timing features are only
+    # computed if a template is given, and are -999 otherwise.
+    # returns a dict of [N] arrays, keyed by FEATURE_NAMES, or only by the
+    # features in the given FEATURE_GROUPS
+    if groups is None:
+        groups = list(FEATURE_GROUPS)
+    times = np.atleast_2d(times)
+    vs = np.atleast_2d(vs)
+    nevt, nsamp = vs.shape
+    out = {}
+
+    istart, iend = getWindow(times, tstart, tend)
+    ipre = istart*3//4
+    cols = np.arange(nsamp)
+
+    # offset is the mean of samples [30, ipre), noise the 5-95% spread of [0, ipre)
+    inoff = (cols >= 30) & (cols < ipre[:,np.newaxis])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out["offset"] = np.sum(np.where(inoff, vs, 0.), axis=1) / np.sum(inoff, axis=1)
+    if "baseline" in groups:
+        out["noise"] = 0.5*(rowPercentile(vs, ipre, 95) - rowPercentile(vs, ipre, 5))
+
+    # trapezoid area over samples [istart, iend) from cumulative sums of
+    # the per-interval areas
+    v = vs - out["offset"][:,np.newaxis]
+    if "area" in groups:
+        seg = np.diff(times, axis=1) * (v[:,1:] + v[:,:-1]) / 2.0
+        cum = np.zeros((nevt, nsamp))
+        np.cumsum(seg, axis=1, out=cum[:,1:])
+        rows = np.arange(nevt)
+        ilast = np.maximum(iend-1, istart)
+        out["area"] = cum[rows,ilast] - cum[rows,istart]
+
+    if "timing" in groups:
+        if template is None:
+            for k in FEATURE_GROUPS["timing"]:
+                out[k] = np.full(nevt, -999.)
+        else:
+            out.update(getTiming(times, v, template, tstart, tend))
+
+    if "baseline" not in groups:
+        del out["offset"]
+    return out
+
+def getGroupParams(group, tstart, tend, template=None, channel=None):
+    # the parameters that the features in a group depend on
+    params = {"channel": str(channel), "tstart": float(tstart)}
+    if group in ["area", "timing"]:
+        params["tend"] = float(tend)
+    if group == "timing":
+        params["template"] = "none" if template is None else \
+            hashlib.md5(np.ascontiguousarray(template, dtype=float).tobytes()).hexdigest()
+    return params
+
+def getCacheName(fname, group, params):
+    key = hashlib.md5(repr(sorted(params.items())).encode("utf-8")).hexdigest()[:12]
+    return "{0}.{1}_{2}.npz".format(fname, group, key)
+
+def loadCache(fname, group, params, getTimestamps, identity=""):
+    # cached features of a group for fname, made with params. returns a dict
+    # of arrays (plus the event timestamps) over the leading events that are
+    # still valid, empty arrays if there are none. identity identifies the
+    # contents of the input (e.g. a hash of its conversion settings and
+    # first waveform), and the cache is only used if it's unchanged. if the
+    # file has changed since the cache was written, it's only taken to have
+    # grown if it has more events than the cache, and getTimestamps() is
+    # called to get their timestamps: the cached events are kept only if
+    # their timestamps are unchanged (None means they can't be checked)
+    empty = {k: np.zeros(0) for k in FEATURE_GROUPS[group] + ["timestamps"]}
+    cname = getCacheName(fname, group, params)
+    if not os.path.exists(cname):
+        return empty
+    try:
+        cache = dict(np.load(cname))
+    except Exception:
+        return empty
+
+    if str(cache.get("identity", "")) != identity:
+        return empty
+    st = os.stat(fname)
+    if cache["size"] == st.st_size and cache["mtime"] == st.st_mtime:
+        n = cache["timestamps"].size
+    else:
+        timestamps = getTimestamps()
+        if timestamps is None or timestamps.size <= cache["timestamps"].size:
+            return empty
+        n = cache["timestamps"].size
+        if np.any(timestamps[:n] != cache["timestamps"][:n]):
+            return empty
+    return {k: cache[k][:n] for k in empty}
+
+def saveCache(fname, group, params, values, identity=""):
+    # cache the features of a group (and the "timestamps" of the events
+    # they belong to) for fname, as it is now, with its identity (see
+    # loadCache)
+    st = os.stat(fname)
+    cname = getCacheName(fname, group, params)
+    cache = {k: values[k] for k in FEATURE_GROUPS[group] + ["timestamps"]}
+    cache.update({"size": st.st_size, "mtime": st.st_mtime, "identity": identity})
+    cache.update({"param_"+k: v for k,v in params.items()})
+    # write to a temporary file first so that a reader never sees half a cache
+    with open(cname + ".tmp", 'wb') as fout:
+        np.savez(fout, **cache)
+    os.rename(cname + ".tmp", cname)
@@ -1,5 +1,6 @@
 #include "TFile.h"
 #include "TString.h"
+#include "TRandom3.h"
 
 // Library Includes
 #include <iostream>
@@ -62,23 +63,27 @@ class SPE {
      *     - can be changed by specifying another path
      *   output_sample_freq: sampling frequency of the output waveform (GHz)
      *   verbose: toggle printout of computed areas
+     *   rng: random number generator for the areas, seeded with the seed
+     *     given to the constructor or SetSeed (0 picks a random seed)
      */
 
     PMT* pmt;
     double output_sample_freq;
     bool verbose;
+    TRandom3 rng;
 
     public:
         // Constructors
         SPE();
        ~SPE();
-        SPE(TString, double, bool);
+        SPE(TString, double, bool, UInt_t seed = 0);
         // Setters
         void SetAreasFile(TString);
         void SetTemplateFile(TString);
         void SetInputSampleFreq(double);
         void SetOutputSampleFreq(double);
         void SetVerbose(bool);
+        void SetSeed(UInt_t);
         // Utility
         TH1D* Generate();
 
@@ -88,12 +93,14 @@ SPE::SPE() {
     pmt = new PMT("r878");
     output_sample_freq = 2.0;
     verbose = false;
+    rng.SetSeed(0);
 }
 // Overload Constructor
-SPE::SPE(TString pmt_name, double new_output_sample_freq, bool is_verbose) {
+SPE::SPE(TString pmt_name, double new_output_sample_freq, bool is_verbose, UInt_t seed) {
     pmt = new PMT(pmt_name);
     output_sample_freq = new_output_sample_freq;
     verbose = is_verbose;
+    rng.SetSeed(seed);
 }
 // Destructor
 SPE::~SPE() {}
@@ -122,6 +129,9 @@ void SPE::SetOutputSampleFreq(double new_output_sample_freq) {
 void SPE::SetVerbose(bool is_verbose) {
     verbose = is_verbose;    
 }
+void SPE::SetSeed(UInt_t seed) {
+    rng.SetSeed(seed);
+}
 
 // Generate SPE Waveform
 TH1D* SPE::Generate() {
@@ -173,7 +183,7 @@ TH1D* SPE::Generate() {
         }
     }
     // Get random area from distribution
-    double area = h_areas->GetRandom();
+    double area = h_areas->GetRandom(&rng);
     // Scale h_volts
     h_volts->Scale(area / prenorm_area);
     if (verbose) {
@@ -0,0 +1,239 @@
+## vectorized simulation of PMT events at a given occupancy: a Poisson
+## number of photoelectrons per event, each an SPE (see ptgen.py) arriving
+## with some time jitter, optionally followed by afterpulses, on top of
+## gaussian baseline noise. the waveforms are sampled on DRS4-like uneven
+## time grids, and come out like the times/voltages of a processBinary.py
+## output (pulses negative), with the true pulses alongside in CSR style
+## (like findAPsBatch), so the processing chain can be run on them and
+## checked against the truth
+
+import os
+import sys
+import time
+import argparse
+import collections
+import multiprocessing
+import numpy as np
+from ptgen import loadModel, model_defs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import drsreader
+
+N_BINS = drsreader.N_BINS
+
+def getBinWidths(fname, channel=None):
+    # the bin widths [N_BINS] of a channel (the first one by default) from
+    # the TIME block of a DRS .dat file
+    with open(fname, 'rb') as fid:
+        hdr = drsreader.readHeader(fid, verbose=False)
+    ich = 0 if channel is None else hdr["channels"].index(channel)
+    return hdr["bin_widths"][ich]
+
+class EventSimulator(object):
+    # model: PMT model of the SPEs (see ptgen.model_defs)
+    # bin_widths: DRS bin widths [N_BINS] (ns) of the simulated channel, e.g.
+    #   from getBinWidths. None for even bins at samp_freq (GHz)
+    # seed: seeds all of the random numbers, as in ptgen.SPEGenerator
+    # mean_npe: mean number of photoelectrons per event
+    # t0, jitter: mean and rms (ns) of the time of the SPE peaks, relative to
+    #   the first sample of the event
+    # noise, offset: rms and mean (mV) of the gaussian baseline
+    # ap_rate: mean number of afterpulses per photoelectron
+    # ap_delays: (mean, sigma, weight) of the gaussian components (ns) of the
+    #   delay of an afterpulse after its photoelectron
+    # ap_npe: mean number of photoelectrons in an afterpulse (1 + Poisson)
+    def __init__(self, model="r878", bin_widths=None, samp_freq=2.0, seed=None,
+                 mean_npe=1.0, t0=260., jitter=1.0, noise=0.38, offset=0.,
+                 ap_rate=0., ap_delays=((500., 50., 1.),), ap_npe=1.):
+        self.model = model
+        self.mean_npe = mean_npe
+        self.t0 = t0
+        self.jitter = jitter
+        self.noise = noise
+        self.offset = offset
+        self.ap_rate = ap_rate
+        self.ap_delays = np.array(ap_delays, dtype=float).reshape(-1, 3)
+        self.ap_npe = ap_npe
+        self.seed = np.random.SeedSequence(seed).entropy
+        self.rng = np.random.default_rng(self.seed)
+
+        # the template at its own sampling rate, which is interpolated
+        # linearly to any time, and its area
+        assets = loadModel(model, model_defs[model]["input_rate"])
+        self.template = assets["template"]
+        self.template_dt = assets["times"][1] - assets["times"][0]
+        self.tpeak = assets["times"][np.argmax(self.template)]
+        self.prenorm_area = assets["prenorm_area"]
+        self.spe_areas = assets["spe_areas"]
+
+        # the time axis of an event for every trigger cell
+        if bin_widths is None:
+            bin_widths = np.full(N_BINS, 1.0/samp_freq)
+        self.bin_widths = np.asarray(bin_widths, dtype=float)
+        self.time_table = drsreader.getTimes(self.bin_widths[np.newaxis], np.arange(N_BINS), [0])[:,0]
+        # the most samples that an SPE can span, starting from any cell
+        span = self.template_dt * (self.template.size-1)
+        cw = np.concatenate([[0.], np.cumsum(np.tile(self.bin_widths, 2))])
+        self.window = int(np.amax(np.searchsorted(cw, cw[:N_BINS] + span, side='right') - np.arange(N_BINS))) + 1
+
+    def blockRNG(self, iblock):
+        # the stream of block iblock, as in ptgen.SPEGenerator
+        return np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(iblock,)))
+
+    def render(self, times, event, ptime, area):
+        # the sum of the SPE shaped pulses (positive) with peak times ptime and
+        # areas area in events event, sampled at times [N,nsamp]. every pulse
+        # fills a window of samples from its start, and the windows are added
+        # up with a single bincount
+        nevt, nsamp = times.shape
+        out = np.zeros(nevt*nsamp)
+        if event.size > 0:
+            # first sample of each pulse, from a search over all of the rows
+            # laid end to end
+            tstart = ptime - self.tpeak
+            span = np.amax(times[:,-1]) + 1.
+            flat = (times + span*np.arange(nevt)[:,np.newaxis]).ravel()
+            s = np.searchsorted(flat, np.clip(tstart, 0., span-0.5) + span*event) - event*nsamp
+
+            cols = s[:,np.newaxis] + np.arange(self.window)
+            valid = cols < nsamp
+            cols = np.minimum(cols, nsamp-1)
+            rows = event[:,np.newaxis]
+            u = (times[rows,cols] - tstart[:,np.newaxis]) / self.template_dt
+            i = np.floor(u).astype(int)
+            inside = valid & (i >= 0) & (i < self.template.size-1)
+            i = np.clip(i, 0, self.template.size-2)
+            v = self.template[i] + (self.template[i+1] - self.template[i]) * (u - i)
+            w = np.where(inside, v * (area/self.prenorm_area)[:,np.newaxis], 0.)
+            out += np.bincount((rows*nsamp + cols).ravel(), weights=w.ravel(), minlength=nevt*nsamp)
+        return out.reshape(nevt, nsamp)
+
+    def generate(self, n, rng=None, trig_cell=None):
+        # simulate n events, with the given trigger cells (random if None).
+        # returns a dict with
+        #   times, voltages [n,N_BINS]: as in a processBinary.py output
+        #   trig_cell [n]: the trigger cells of the events
+        #   npe, true_area [n]: number and total area of the photoelectrons
+        #     of each event, not counting afterpulses
+        # and the true pulses (single photoelectrons and afterpulses) in CSR
+        # style: those of event i are entries offsets[i]:offsets[i+1], in time
+        # order, of "event", "time" (peak time), "area", "pulse_npe" and
+        # "afterpulse" (whether it's an afterpulse)
+        rng = rng or self.rng
+        if trig_cell is None:
+            trig_cell = rng.integers(0, N_BINS, n)
+        times = self.time_table[trig_cell]
+        npe = rng.poisson(self.mean_npe, n)
+        event = np.repeat(np.arange(n), npe)
+        ptime = self.t0 + self.jitter*rng.standard_normal(event.size)
+        pnpe = np.ones(event.size, dtype=int)
+        isap = np.zeros(event.size, dtype=bool)
+        if self.ap_rate > 0:
+            nap = rng.poisson(self.ap_rate, event.size)
+            parent = np.repeat(np.arange(event.size), nap)
+            comp = rng.choice(len(self.ap_delays), size=parent.size, p=self.ap_delays[:,2]/np.sum(self.ap_delays[:,2]))
+            delay = self.ap_delays[comp,0] + self.ap_delays[comp,1]*rng.standard_normal(parent.size)
+            event = np.concatenate([event, event[parent]])
+            ptime = np.concatenate([ptime, ptime[parent] + delay])
+            pnpe = np.concatenate([pnpe, 1 + rng.poisson(max(self.ap_npe-1, 0.), parent.size)])
+            isap = np.concatenate([isap, np.ones(parent.size, dtype=bool)])
+
+        # the area of a pulse is the sum of the areas of its photoelectrons
+        spe = self.spe_areas.sample(int(np.sum(pnpe)), rng)
+        area = np.add.reduceat(spe, np.cumsum(pnpe) - pnpe) if spe.size > 0 else np.zeros(0)
+
+        voltages = self.offset - self.render(times, event, ptime, area)
+        if self.noise:
+            voltages += self.noise * rng.standard_normal(voltages.shape)
+
+        order = np.lexsort((ptime, event))
+        return {"times": times,
+                "voltages": voltages,
+                "trig_cell": trig_cell,
+                "npe": npe,
+                "true_area": np.bincount(event[~isap], weights=area[~isap], minlength=n),
+                "offsets": np.concatenate([[0], np.cumsum(np.bincount(event, minlength=n))]),
+                "event": event[order],
+                "time": ptime[order],
+                "area": area[order],
+                "pulse_npe": pnpe[order],
+                "afterpulse": isap[order]}
+
+    def iterBatches(self, n, batch_size=10000, njobs=1):
+        # generator over n events in batches of batch_size, as returned by
+        # generate(), made by njobs worker processes. every batch draws from
+        # its own stream (blockRNG), so the events only depend on the seed and
+        # batch_size, and the batches come back in order. at most 2*njobs
+        # batches are in flight at once, so a slow consumer doesn't pile
+        # them up in memory
+        blocks = [(i, min(batch_size, n-i*batch_size)) for i in range((n + batch_size - 1) // batch_size)]
+        njobs = max(1, min(njobs, len(blocks)))
+        if njobs == 1:
+            for block in blocks:
+                yield self.generate(block[1], self.blockRNG(block[0]))
+            return
+
+        pool = multiprocessing.Pool(njobs, _initWorker, (self,))
+        pending = collections.deque()
+        try:
+            for block in blocks:
+                pending.append(pool.apply_async(_simulateBlock, (block,)))
+                if len(pending) >= 2*njobs:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+            pool.join()
+
+_worker_sim = {}
+def _initWorker(sim):
+    _worker_sim["sim"] = sim
+
+def _simulateBlock(block):
+    sim = _worker_sim["sim"]
+    return sim.generate(block[1], sim.blockRNG(block[0]))
+
+if __name__ == "__main__":
+    # simulate events and run the pulse features on them, printing the
+    # throughput and how the reconstructed areas compare to the truth
+    import features
+
+    parser = argparse.ArgumentParser(description="Simulate PMT events and check the pulse features against the truth")
+    parser.add_argument("-n", "--nevents", type=int, default=100000, help="number of events")
+    parser.add_argument("--npe", type=float, default=1.0, help="mean number of photoelectrons per event")
+    parser.add_argument("--model", default="r878", help="PMT model")
+    parser.add_argument("--dat", default=None, help="take the bin widths from the TIME block of this .dat file")
+    parser.add_argument("--samp-freq", type=float, default=2.0, help="sampling rate (GHz) without --dat")
+    parser.add_argument("--seed", type=int, default=None, help="random seed")
+    parser.add_argument("--tstart", type=float, default=230, help="start of the pulse window (ns)")
+    parser.add_argument("--tend", type=float, default=330, help="end of the pulse window (ns)")
+    parser.add_argument("--batch-size", type=int, default=10000, help="events per batch")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(), help="number of worker processes")
+    args = parser.parse_args()
+
+    bin_widths = getBinWidths(args.dat) if args.dat else None
+    sim = EventSimulator(args.model, bin_widths, args.samp_freq, args.seed, mean_npe=args.npe)
+    print("Seed: {0}".format(sim.seed))
+
+    tsim, tfeat = 0., 0.
+    area, true_area, npe = [], [], []
+    t1 = time.time()
+    for batch in sim.iterBatches(args.nevents, args.batch_size, args.jobs):
+        t2 = time.time()
+        res = features.computeFeatures(batch["times"], -batch["voltages"], args.tstart, args.tend, groups=["area"])
+        t3 = time.time()
+        tsim += t2 - t1
+        tfeat += t3 - t2
+        area.append(res["area"])
+        true_area.append(batch["true_area"])
+        npe.append(batch["npe"])
+        t1 = time.time()
+    area, true_area, npe = np.concatenate(area), np.concatenate(true_area), np.concatenate(npe)
+
+    print("Simulated {0} events in {1:.1f} s ({2:.0f} events/s), features in {3:.1f} s ({4:.0f} events/s)".format(
+        args.nevents, tsim, args.nevents/tsim, tfeat, args.nevents/tfeat))
+    for k in range(min(np.amax(npe), 5)+1):
+        sel = npe == k
+        if np.any(sel):
+            print("  {0} PE: {1} events, mean area {2:.2f} (true {3:.2f}), rms difference {4:.2f}".format(
+                k, np.sum(sel), np.mean(area[sel]), np.mean(true_area[sel]), np.std(area[sel]-true_area[sel])))
@@ -1,81 +1,193 @@
+import os
+import multiprocessing
 import ROOT as r
 import numpy as np
-import cPickle as pickle
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# np.trapz, which newer numpy calls trapezoid
+trapz = np.trapezoid if hasattr(np, "trapezoid") else np.trapz
 
 model_defs = {
     "r878": {
         "template": "assets/template_peak_70_75_2GHz.pkl",
+        "areas": "assets/r878_areas.root",
         "input_rate": 2.5,
         }
     }
 
-def GenerateSignal(model="r878", output_samp_freq=2.0, noise=None, extend=None, verbose=False):
-    # model defines which PMT to use (see model_defs above)
-    # output_samp_freq is the sampling frequency of the ouput waveform
-    # (in GHz, so 2.0 means time bin spacing of 0.5 ns)
-    # if noise is not None, add random gaussian noise of rms 'noise'
-    # if extend is not None, extend each side of output waveform by 'extend' ns of zero voltage
+class AreaSampler(object):
+    # draws areas from a 1D histogram in bulk, the way TH1::GetRandom does:
+    # a bin is picked from the cumulative bin contents, and the area is
+    # interpolated linearly within it. negative bins are taken as empty, and
+    # the under/overflow bins are ignored
+    def __init__(self, edges, contents):
+        self.edges = np.asarray(edges, dtype=float)
+        cum = np.concatenate([[0.], np.cumsum(np.clip(np.asarray(contents, dtype=float), 0, None))])
+        if cum[-1] <= 0:
+            raise Exception("Area histogram is empty!")
+        self.integral = cum / cum[-1]
+
+    @staticmethod
+    def fromTH1(h):
+        # from any ROOT 1D histogram, e.g. the SPE area spectra in the assets or
+        # the background-subtracted one from scripts/plot_areas.py
+        nbins = h.GetNbinsX()
+        edges = np.array([h.GetBinLowEdge(i) for i in range(1, nbins+2)])
+        contents = np.array([h.GetBinContent(i) for i in range(1, nbins+1)])
+        return AreaSampler(edges, contents)
 
-    # Set seed
-    r.gRandom.SetSeed(0);
+    def sample(self, n, rng=np.random):
+        u = rng.random(n)
+        nbins = self.edges.size-1
+        ibin = np.clip(np.searchsorted(self.integral, u, side='right') - 1, 0, nbins-1)
+        lo, hi = self.integral[ibin], self.integral[ibin+1]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            frac = np.where(u > lo, (u - lo) / (hi - lo), 0.)
+        return self.edges[ibin] + (self.edges[ibin+1] - self.edges[ibin]) * frac
+
+# resampled templates and area distributions, loaded once per
+# (model, output_samp_freq)
+_model_cache = {}
+
+def getAssetPath(path):
+    # asset paths in model_defs are relative to this directory
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+
+def loadModel(model, output_samp_freq):
+    # the template of a PMT model resampled to output_samp_freq, with its
+    # area, and its SPE area distribution (with any
+    # negative bins set to 0). cached, so the assets are only read once
+    key = (model, output_samp_freq)
+    if key in _model_cache:
+        return _model_cache[key]
 
     if model not in model_defs:
         raise Exception("No model definition for PMT model {0}!".format(model))
 
-    template_file = model_defs[model]["template"]
+    template_file = getAssetPath(model_defs[model]["template"])
     input_rate = model_defs[model]["input_rate"]
     dt = 1.0 / input_rate
 
     # Load template
     with open(template_file, "rb") as pin:
         # Get template y-array (millivolts)
-        template_y = pickle.load(pin)
+        try:
+            template_y = pickle.load(pin, encoding="latin1")
+        except TypeError:
+            template_y = pickle.load(pin)
         # Construct template x-array (ns)
         template_x = np.arange(0, dt * template_y.size, dt)
 
-        
-    # re-sample with new time values
+    # re-sample with new time values, interpolating linearly between the
+    # template samples on either side (0 outside of the template)
     new_dt = 1.0 / output_samp_freq
     times = np.arange(0, template_x[-1] + 1e-9, new_dt)
-    voltages = []
-    curj = 0
-    for i in range(times.size):
-        while curj < template_x.size and template_x[curj] < times[i]:
-            curj += 1
-        if curj==0 or curj==template_x.size:
-            voltages.append(0.0)
+    j = np.searchsorted(template_x, times, side='left')
+    inside = (j > 0) & (j < template_x.size)
+    j = np.clip(j, 1, template_x.size-1)
+    voltages = np.where(inside, template_y[j-1] + (template_y[j] - template_y[j-1])/(template_x[j] - template_x[j-1]) * (times - template_x[j-1]), 0.0)
+
+    prenorm_area = trapz(voltages, times)
+
+    # Load areas (SPE area dist)
+    areas = r.TFile.Open(getAssetPath(model_defs[model]["areas"]))
+    spe_areas = AreaSampler.fromTH1(areas.Get("ht"))
+    areas.Close()
+
+    _model_cache[key] = {"times": times,
+                         "template": voltages,
+                         "prenorm_area": prenorm_area,
+                         "spe_areas": spe_areas}
+    return _model_cache[key]
+
+class SPEGenerator(object):
+    # generates batches of SPE waveforms for one PMT model (see model_defs
+    # above) at output_samp_freq (GHz).
+    # all random numbers (areas and noise) come from one numpy Generator
+    # seeded with seed, so a given seed always gives the same waveforms. with
+    # seed=None a fresh seed is drawn, which is kept in self.seed so the
+    # output can be reproduced
+    def __init__(self, model="r878", output_samp_freq=2.0, seed=None):
+        self.model = model
+        self.output_samp_freq = output_samp_freq
+        self.assets = loadModel(model, output_samp_freq)
+        self.seed = np.random.SeedSequence(seed).entropy
+        self.rng = np.random.default_rng(self.seed)
+
+    def generateAreas(self, n, rng=None):
+        return self.assets["spe_areas"].sample(n, rng or self.rng)
+
+    def generate(self, n, noise=None, extend=None, verbose=False, rng=None):
+        # returns the times [nsamples] and n waveforms [n, nsamples], each the
+        # template scaled to a random SPE area.
+        # if noise is not None, add random gaussian noise of rms 'noise'
+        # if extend is not None, extend each side of output waveform by 'extend' ns of zero voltage
+        # the random numbers come from rng if given, else from self.rng
+        rng = rng or self.rng
+        times = self.assets["times"]
+        areas = self.generateAreas(n, rng)
+        voltages = self.assets["template"] * (areas/self.assets["prenorm_area"])[:,np.newaxis]
+        if verbose:
+            for area, v in zip(areas, voltages):
+                postnorm_area = trapz(v, times)
+                print("SPE Area: {0}, Original Template Area: {1}, Scaled Template Area: {2}".format(
+                    area, self.assets["prenorm_area"], postnorm_area))
+
+        if extend is not None:
+            new_dt = 1.0 / self.output_samp_freq
+            nsamp = int(extend/new_dt)
+            times = np.arange(0, new_dt*(times.size + 2*nsamp), new_dt)
+            voltages = np.pad(voltages, ((0,0), (nsamp,nsamp)), mode='constant')
+
+        if noise is not None:
+            voltages = voltages + rng.normal(loc=0.0, scale=noise, size=voltages.shape)
+
+        return times, voltages
+
+    def blockRNG(self, iblock):
+        # the stream of block iblock: the iblock'th child of self.seed, as
+        # SeedSequence.spawn would give, but without having to spawn the
+        # ones before it
+        return np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(iblock,)))
+
+    def generateBlocks(self, n, noise=None, extend=None, block_size=100000, njobs=1):
+        # n waveforms, as generate(), made in blocks of block_size that are
+        # spread over njobs worker processes. every block draws from its own
+        # stream (blockRNG), so the output depends only on the seed and
+        # block_size, not on njobs or on which worker made which block
+        blocks = [(self.model, self.output_samp_freq, self.seed, i, min(block_size, n-i*block_size), noise, extend)
+                  for i in range((n + block_size - 1) // block_size)]
+        njobs = max(1, min(njobs, len(blocks)))
+        if njobs == 1:
+            results = [_generateBlock(b) for b in blocks]
         else:
-            voltages.append( template_y[curj-1] + (template_y[curj] - template_y[curj-1])/(template_x[curj] - template_x[curj-1]) * (times[i] - template_x[curj-1]) )
-    voltages = np.array(voltages)
-        
-    prenorm_area = np.trapz(voltages, times)
-
-    # Load areas
-    areas = r.TFile.Open("assets/r878_areas.root")
-    # SPE area dist
-    spe_areas = (areas.Get("ht")).Clone("spe")
-    for b in range(0, spe_areas.GetSize()):
-        # Kill any negative areas
-        if spe_areas.GetBinContent(b) < 0: spe_areas.SetBinContent(b, 0)
-
-    # Get random area        
-    area = spe_areas.GetRandom()
-    # Scale template y-values
-    voltages *= area/prenorm_area
-    if verbose: 
-        postnorm_area = np.trapz(voltages, times)
-        print("SPE Area: {0}, Original Template Area: {1}, Scaled Template Area: {2}".format(area, prenorm_area, postnorm_area))
-
-    if extend is not None:
-        nsamp = int(extend/new_dt)
-        times = np.arange(0, new_dt*(times.size + 2*nsamp), new_dt)
-        voltages = np.append(voltages, np.zeros(nsamp))
-        voltages = np.append(np.zeros(nsamp), voltages)
-        
-    if noise is not None:
-        voltages += np.random.normal(loc=0.0, scale=noise, size=voltages.size)
-
-    return times, voltages
+            pool = multiprocessing.Pool(njobs)
+            results = pool.map(_generateBlock, blocks)
+            pool.close()
+            pool.join()
+        if len(results) == 0:
+            return self.generate(0, noise, extend)
+        return results[0][0], np.concatenate([v for t,v in results])
+
+def _generateBlock(block):
+    # one block of SPEGenerator.generateBlocks, in whichever process runs it
+    model, output_samp_freq, seed, iblock, n, noise, extend = block
+    gen = SPEGenerator(model, output_samp_freq, seed)
+    return gen.generate(n, noise, extend, rng=gen.blockRNG(iblock))
+
+def GenerateSignal(model="r878", output_samp_freq=2.0, noise=None, extend=None, verbose=False, seed=None):
+    # model defines which PMT to use (see model_defs above)
+    # output_samp_freq is the sampling frequency of the ouput waveform
+    # (in GHz, so 2.0 means time bin spacing of 0.5 ns)
+    # if noise is not None, add random gaussian noise of rms 'noise'
+    # if extend is not None, extend each side of output waveform by 'extend' ns of zero voltage
+    # seed seeds the random numbers, None for a fresh seed
+    # (a single waveform from SPEGenerator)
+    times, voltages = SPEGenerator(model, output_samp_freq, seed).generate(1, noise, extend, verbose)
+    return times, voltages[0]
 
 if __name__ == "__main__":
     times, voltages = GenerateSignal(output_samp_freq=2.0, noise=0.38, extend=150, verbose=True)
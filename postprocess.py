@@ -3,11 +3,16 @@
 ## take output root file from processBinary.py and
 ## add higher level information like pulse time, area, etc
 
+import os
 import sys
+import hashlib
+import argparse
+import multiprocessing
 import ROOT as r
 import numpy as np
 import matplotlib.pyplot as plt
-import cPickle as pickle
+import features
+import treeio
 
 tstart = 230
 tend   = 330
@@ -19,106 +24,200 @@ tend   = 330
 # tend   = 390
 
 # determine the pulse time/width and store in tree
-# (fairly time-consuming)
 doTiming = False
 
+# number of events read and processed at a time
+chunkSize = 10000
+
+templateFile, templateStride = None, 1
 if doTiming:
-    # template = pickle.load(open("peak_templates/template_peak_70_75_2GHz.pkl", 'rb'))[::2]
-    template = pickle.load(open("peak_templates/template_peak_r7725_400_550_1GHz.pkl", 'rb'))[::1]
-    template /= np.sum(template)
-
-f = r.TFile(sys.argv[1], "UPDATE")
-t = f.Get("Events")
-
-times = np.zeros(1024, dtype=float)
-voltages = np.zeros(1024, dtype=float)
-area = np.array([0], dtype=float)
-offset = np.array([0], dtype=float)
-noise = np.array([0], dtype=float)
-smoothed_max = np.array([0], dtype=float)
-tmax = np.array([0], dtype=float)
-thalfmax = np.array([0], dtype=float)
-fwhm = np.array([0], dtype=float)
-
-
-t.SetBranchStatus("*", 0)
-t.SetBranchStatus("times", 1)
-t.SetBranchStatus("voltages", 1)
-nt = t.CloneTree()
-
-nt.SetBranchAddress("times",times)
-nt.SetBranchAddress("voltages",voltages)
-b_area = nt.Branch("area", area, "area/D")
-b_offset = nt.Branch("offset", offset, "offset/D")
-b_noise = nt.Branch("noise", noise, "noise/D")
-b_smoothed_max = nt.Branch("smoothed_max", smoothed_max, "smoothed_max/D")
-b_tmax = nt.Branch("tmax", tmax, "tmax/D")
-b_thalfmax = nt.Branch("thalfmax", thalfmax, "thalfmax/D")
-b_fwhm = nt.Branch("fwhm", fwhm, "fwhm/D")
+    # templateFile, templateStride = "peak_templates/template_peak_70_75_2GHz.pkl", 2
+    templateFile, templateStride = "peak_templates/template_peak_r7725_400_550_1GHz.pkl", 1
+
+parser = argparse.ArgumentParser(description="Add pulse features to the output of processBinary.py")
+parser.add_argument("input", help="output file of processBinary.py")
+parser.add_argument("channel", nargs="?", default=None,
+                    help="channel to process in a multi-channel file; its features are then stored as area_<chan> etc.")
+parser.add_argument("--tstart", type=float, default=tstart, help="start of the pulse window (ns)")
+parser.add_argument("--tend", type=float, default=tend, help="end of the pulse window (ns)")
+parser.add_argument("--template", default=templateFile,
+                    help="peak template pickle; if given, the pulse timing is computed too")
+parser.add_argument("--stride", type=int, default=templateStride, help="keep every stride'th template sample")
+parser.add_argument("--friend", action="store_true",
+                    help="write only the features, to a separate file that can be added as a friend of the Events tree")
+parser.add_argument("-o", "--output", default=None, help="feature file for --friend (default <input>_features.root)")
+parser.add_argument("--tree", default="Features", help="name of the feature tree for --friend")
+parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+                    help="number of worker processes")
+parser.add_argument("--no-cache", action="store_true", help="recompute every feature, and don't cache them")
+args = parser.parse_args()
+
+template = None
+if args.template:
+    template = features.loadTemplate(args.template, args.stride)
+
+extra = "_"+args.channel if args.channel is not None else ""
+names = [k+extra for k in features.FEATURE_NAMES]
+
+if args.friend:
+    # leave the input alone, and write the features to their own tree
+    f = r.TFile(args.input)
+    t = f.Get("Events")
+    nt = t
+    outname = args.output or os.path.splitext(args.input)[0] + "_features.root"
+    params = {"input": os.path.basename(args.input), "tstart": args.tstart, "tend": args.tend,
+              "template": os.path.basename(args.template) if args.template else "none", "stride": args.stride}
+    out = treeio.FeatureTree(outname, args.tree, names, params)
+    print("Writing features to {0}:{1}".format(outname, args.tree))
+else:
+    f = r.TFile(args.input, "UPDATE")
+    t = f.Get("Events")
+
+    bufs = {k: np.array([0], dtype=float) for k in names}
+
+    # keep every branch (the other channels, timestamp, trig_cell, ...) and
+    # drop only the features being redone, which are added back below
+    t.SetBranchStatus("*", 1)
+    for k in names:
+        if t.GetBranch(k):
+            t.SetBranchStatus(k, 0)
+    nt = t.CloneTree()
+    t.SetBranchStatus("*", 1)
+
+    branches = [nt.Branch(k, bufs[k], k+"/D") for k in names]
 
 Nevt = nt.GetEntries()
-for ievt in range(Nevt):
-# for ievt in range(10000):
-    nt.GetEntry(ievt)
-
-    if ievt%10000==0:
-        print "iEvt:", ievt
 
-    vs = -voltages
+def readTimestamps(tree, start=0, stop=None):
+    # timestamps of the input events, which tell whether cached features
+    # still belong to them. files without them fall back to entry numbers
+    if not tree.GetBranch("timestamp"):
+        return None
+    return treeio.readBranches(tree, ["timestamp"], start, stop)["timestamp"]
+
+def readWaveforms(tree, istart, istop):
+    # times and voltages [N,1024] of the channel for entries [istart, istop),
+    # through treeio.iterTree so that files written with either schema
+    # (including --compact) can be read. files without per-channel
+    # branches are read directly
+    if args.channel is None:
+        if not tree.GetBranch("times"):
+            raise Exception("{0} has no times branch, give the channel to process".format(args.input))
+        d = treeio.readBranches(tree, ["times", "voltages"], istart, istop)
+        return d["times"], d["voltages"]
+    batches = list(treeio.iterTree(args.input, istop-istart, [int(args.channel)], istart, istop))
+    return batches[0][2][:,0], batches[0][3][:,0]
+
+def getIdentity():
+    # what the input was converted with and from: the settings and channels
+    # stored by processBinary.py (and the bin widths of a compact file),
+    # and the first waveform. the timestamps stay the same when a run is
+    # converted again, so a cache is only reused if these are unchanged too
+    h = hashlib.md5()
+    settings = f.Get("settings")
+    h.update((settings.GetTitle() if settings else "none").encode("utf-8"))
+    if f.Get("chans"):
+        h.update(str(treeio.getChannels(f)).encode("utf-8"))
+    if treeio.isCompact(f):
+        h.update(np.ascontiguousarray(treeio.getHeader(f)["bin_widths"]).tobytes())
+    if Nevt > 0:
+        times, voltages = readWaveforms(t, 0, 1)
+        h.update(np.ascontiguousarray(times, dtype=float).tobytes())
+        h.update(np.ascontiguousarray(voltages, dtype=float).tobytes())
+    return h.hexdigest()
+
+allTimestamps = []
+def getTimestamps():
+    if len(allTimestamps)==0:
+        allTimestamps.append(readTimestamps(t))
+    return allTimestamps[0]
+
+# features are cached next to the input for each group, keyed by the
+# parameters the group depends on, so only the groups affected by a change
+# (and only events added since the last run) are recomputed
+groups = sorted(features.FEATURE_GROUPS)
+gparams = {g: features.getGroupParams(g, args.tstart, args.tend, template, args.channel) for g in groups}
+identity = getIdentity()
+cached = {}
+for g in groups:
+    if args.no_cache:
+        cached[g] = {k: np.zeros(0) for k in features.FEATURE_GROUPS[g] + ["timestamps"]}
+    else:
+        cached[g] = features.loadCache(args.input, g, gparams[g], getTimestamps, identity)
+ncached = {g: min(cached[g]["timestamps"].size, Nevt) for g in groups}
+nfirst = min(ncached.values())
+redo = [g for g in groups if ncached[g] < Nevt]
+for g in groups:
+    print("{0}: {1} cached events, {2} to compute".format(g, ncached[g], Nevt-ncached[g]))
+
+_worker_trees = {}
+def computeRange(rng, tree=None):
+    # features of the input entries [start, stop). in a worker process
+    # (tree=None) they are read through its own handle on the input
+    istart, istop = rng
+    if tree is None:
+        if "Events" not in _worker_trees:
+            _worker_trees["file"] = r.TFile(args.input)
+            _worker_trees["Events"] = _worker_trees["file"].Get("Events")
+        tree = _worker_trees["Events"]
+
+    times, voltages = readWaveforms(tree, istart, istop)
 
     # for j in range(1,vs.size):
     #     if abs(vs[j] - vs[j-1]) > 10:
     #         vs[j] = vs[j-1]
 
-    istart = np.argmax(times>tstart+times[0])
-    iend = np.argmax(times>tend+times[0])
-
-    # offset[0] = np.median(vs)
-    offset[0] = np.mean(vs[30:istart*3/4])
-    noise[0] = 0.5*(np.percentile(vs[:istart*3/4],95) - np.percentile(vs[:istart*3/4],5))
-    
-    vs -= offset[0]
-
-    area[0] = np.trapz(vs[istart:iend], times[istart:iend])
-
-    if not doTiming:
-        smoothed_max[0] = -999
-        tmax[0] = -999
-        thalfmax[0] = -999
-    else:
-        convolved = np.convolve(vs, template[::-1], mode='valid')
-        imax = np.argmax(template)
-        convolved_time = times[imax:imax+convolved.size]
-        icstart = np.argmax(convolved_time>tstart + times[0])
-        icend = np.argmax(convolved_time>tend + times[0])
-        icmax = np.argmax(convolved[icstart:icend]) + icstart
-        cmax = convolved[icmax]
-        ihm = icmax
-        while ihm > icstart and convolved[ihm] > cmax/2:
-            ihm -= 1
-        if cmax < 0.5 or convolved[ihm] > cmax/2:
-            thalfmax[0] = -999
-        else:
-            thalfmax[0] = convolved_time[ihm] + (convolved_time[ihm+1]-convolved_time[ihm])/(convolved[ihm+1]-convolved[ihm]) * (cmax/2 - convolved[ihm])
-        ihm = icmax
-        while ihm <icend and convolved[ihm] > cmax/2:
-            ihm += 1
-        if cmax < 0.5 or convolved[ihm] > cmax/2 or thalfmax[0]<0:
-            fwhm[0] = -999
+    res = features.computeFeatures(times, -voltages, args.tstart, args.tend, template, redo)
+    ts = readTimestamps(tree, istart, istop)
+    res["timestamps"] = ts if ts is not None else np.arange(istart, istop, dtype=float)
+    return istart, res
+
+# the entries still to compute are split into chunks, which are spread over
+# the workers. imap hands them back in entry order, and every chunk is
+# computed the same way wherever it runs, so the merged result is identical
+# to a serial run
+ranges = [(i, min(i+chunkSize, Nevt)) for i in range(nfirst, Nevt, chunkSize)]
+njobs = max(1, min(args.jobs, len(ranges)))
+if njobs == 1:
+    results = (computeRange(rng, t) for rng in ranges)
+else:
+    pool = multiprocessing.Pool(njobs)
+    results = pool.imap(computeRange, ranges)
+
+new = {k: [] for k in features.FEATURE_NAMES + ["timestamps"]}
+for istart, res in results:
+    print("iEvt: {0}".format(istart))
+    for k in res:
+        new[k].append(res[k])
+if njobs > 1:
+    pool.close()
+    pool.join()
+
+values = {}
+for g in groups:
+    values[g] = {}
+    for k in features.FEATURE_GROUPS[g] + ["timestamps"]:
+        if g in redo:
+            values[g][k] = np.concatenate([cached[g][k][:nfirst]] + new[k])
         else:
-            fwhm[0] = convolved_time[ihm] + (convolved_time[ihm-1]-convolved_time[ihm])/(convolved[ihm-1]-convolved[ihm]) * (cmax/2 - convolved[ihm])
-            fwhm[0] -= thalfmax
-
-        smoothed_max[0] = cmax
-        tmax[0] = convolved_time[icmax]
-
-    b_area.Fill()
-    b_offset.Fill()
-    b_noise.Fill()
-    b_smoothed_max.Fill()
-    b_tmax.Fill()
-    b_thalfmax.Fill()
-    b_fwhm.Fill()
-
-nt.Write("Events",r.TObject.kWriteDelete)
+            values[g][k] = cached[g][k][:Nevt]
+res = {}
+for g in groups:
+    res.update({k+extra: values[g][k] for k in features.FEATURE_GROUPS[g]})
+
+if args.friend:
+    out.fill(res)
+    out.close()
+else:
+    for i in range(Nevt):
+        for k,b in zip(names, branches):
+            bufs[k][0] = res[k][i]
+            b.Fill()
+    nt.Write("Events",r.TObject.kWriteDelete)
 f.Close()
+
+# the input has changed if the features were added to it, so the caches
+# are (re)written after it is closed
+if not args.no_cache:
+    for g in groups:
+        features.saveCache(args.input, g, gparams[g], values[g], identity)
@@ -6,8 +6,6 @@
 ## note that time values are different for every event since
 ## DRS binning is uneven, and the trigger can occur in any bin
 
-import struct
-import datetime as dt
 from pytz import utc, timezone
 import json
 import numpy as np
@@ -15,6 +13,14 @@ import ROOT as r
 import os
 from array import array
 from time import mktime
+import sys
+import glob
+import time
+import argparse
+import multiprocessing
+import collections
+import drsreader
+import features
 
 # name = "r878_Helm0p0ALong_1450V_1p92V_13ns_300Hz_50000evnts"
 name = "22022019_KUBoard_BothChan_400V_4V_LED100Hz_1000evts"
@@ -24,182 +30,481 @@ name = "22022019_KUBoard_BothChan_400V_4V_LED100Hz_1000evts"
 indir =  "./inputs"
 outdir = "./outputs"
 
-if not os.path.exists(outdir):
-    os.mkdir(outdir)
-
 fin = indir+"/{0}.dat".format(name)
 
 READ_CHN = [1,2] # can be a single integer or list of integers
-N_BINS = 1024 # number of timing bins per channel
+N_BINS = drsreader.N_BINS # number of timing bins per channel
 POLARITY = 1 # use -1 to invert. peaks must be positive
-
-if type(READ_CHN) == int:
-    READ_CHN = [READ_CHN]
-ts = {c: np.zeros(1024, dtype='float') for c in READ_CHN}
-vs = {c: np.zeros(1024, dtype='float') for c in READ_CHN}
-t = r.TTree("Events","Events")
-timestamp = array('d',[0])
-t.Branch("timestamp",timestamp,'timestamp/D')
-chanArray = r.TArrayI(len(READ_CHN))
-for i,c in enumerate(READ_CHN):
-    chanArray.SetAt(c,i)
-    extra = "_"+str(c)
-    t.Branch("times"+extra, ts[c], 'times{0}[1024]/D'.format(extra))
-    t.Branch("voltages"+extra, vs[c], 'voltages{0}[1024]/D'.format(extra))
-chanString = " ".join(str(x) for x in READ_CHN) 
-
-def getStr(fid, length):
-    data = fid.read(length)
-    if len(data)==0:
-        return None
-    res = struct.unpack("c"*length, data)
-    return "".join(x.decode("utf-8") for x in res)
-
-def getShort(fid, num=1):
-    data = fid.read(2*num)
-    if len(data)==0:
-        return None
-    res = struct.unpack("H"*num, data)
-    return res[0] if num==1 else res
-
-def getFloat(fid, num=1):
-    data = fid.read(4*num)
-    if len(data)==0:
-        return None
-    res = struct.unpack("f"*num, data)
-    return res[0] if num==1 else res
-
-def getInt(fid, num=1):
-    data = fid.read(4*num)
-    if len(data)==0:
-        return None
-    res = struct.unpack("I"*num, data)
-    return res[0] if num==1 else res
-
-fid = open(fin,'rb')
-
-# make sure file header is correct
-fhdr = getStr(fid, 4)
-if fhdr != "DRS2":
-    print("ERROR: unrecognized header "+fhdr)
-    exit(1)
-
-# make sure timing header is correct
-thdr = getStr(fid, 4)
-if thdr != "TIME":
-    print("ERROR: unrecognized time header "+thdr)
-    exit(1)
-
-# get the boards in file
-n_boards = 0
-channels = []
-board_ids = []
-bin_widths = []
-while True:
-    bhdr = getStr(fid, 2)
-    if bhdr != "B#":
-        fid.seek(-2, 1)
-        break
-    board_ids.append( getShort(fid) )
-    n_boards += 1
-    bin_widths.append([])
-    print("Found Board #"+str(board_ids[-1]))
-
+MAX_MEMORY_MB = 512 # rough ceiling on memory used for decoding and tree buffers
+MAX_BASKET_SIZE = 4*1024**2 # largest per-branch basket, in bytes
+COMPACT = False # store raw ADC counts instead of times/voltages (read back with treeio.py)
+TSTART = 230 # pulse window for the features and follow mode statistics (see postprocess.py)
+TEND = 330
+
+def getFirstDate(fin):
+    # timestamp of the first event in the file, as a string
+    with open(fin,'rb') as fid:
+        hdr = drsreader.readHeader(fid, verbose=False)
+        first = drsreader.readEvents(fid, hdr["channels"], 1)
+    return str(float(drsreader.getTimestamps(first["date"])[0])) if first.size else None
+
+def getOutputName(fin, outdir, firstDate):
+    name = os.path.basename(fin)
+    if name.endswith(".dat"):
+        name = name[:-4]
+    return outdir+"/{0}_{1}.root".format(name, str(firstDate).split(".")[0])
+
+def getSettings(read_chn, polarity, compact, feats=None):
+    # the conversion settings that change what goes into the output, as a
+    # string that is stored with it (see OutputTree.close)
+    if type(read_chn) == int:
+        read_chn = [read_chn]
+    settings = {"chans": [int(c) for c in read_chn], "polarity": int(polarity), "compact": bool(compact),
+                "features": None}
+    if feats is not None:
+        settings["features"] = features.getGroupParams("timing", feats["tstart"], feats["tend"], feats["template"])
+        del settings["features"]["channel"]
+    return json.dumps(settings, sort_keys=True)
+
+def isUpToDate(fin, outdir, settings):
+    # whether the output for fin exists, is newer than the input and was
+    # made with the same settings (see getSettings). outputs from before the
+    # settings were stored count as out of date
+    fout = getOutputName(fin, outdir, getFirstDate(fin))
+    if not os.path.exists(fout) or os.path.getmtime(fout) < os.path.getmtime(fin):
+        return False
+    f = r.TFile.Open(fout)
+    if not f or f.IsZombie():
+        return False
+    stored = f.Get("settings")
+    same = bool(stored) and stored.GetTitle() == settings
+    f.Close()
+    return same
+
+def decodeChunk(evts, hdr, read_chn, polarity, compact, feats=None):
+    # everything that goes into the tree for a chunk of event records.
+    # if feats is given (a dict with tstart, tend and template), the pulse
+    # features of each channel are computed while the waveforms are in
+    # memory. like postprocess.py, they are computed on -voltages
+    chunk = {"timestamp": drsreader.getTimestamps(evts["date"]),
+             "trig_cell": evts["trig_cell"],
+             "range": evts["range"]}
+    if compact:
+        chunk["adc"] = [evts["adc_"+str(c)] for c in read_chn]
+    if not compact or feats is not None:
+        _, _, chunk["times"], chunk["voltages"] = drsreader.decodeEvents(evts, hdr, read_chn, polarity)
+    if feats is not None:
+        for j,c in enumerate(read_chn):
+            res = features.computeFeatures(chunk["times"][:,j], -chunk["voltages"][:,j],
+                                           feats["tstart"], feats["tend"], feats["template"])
+            for k in features.FEATURE_NAMES:
+                chunk[k+"_"+str(c)] = res[k]
+    return chunk
+
+# headers (and their time tables) already read by this worker process
+_worker_hdrs = {}
+
+def _decodeRange(args):
+    # pool worker: read and decode events [start, stop) of a file
+    fin, start, stop, read_chn, polarity, compact, feats = args
+    with open(fin,'rb') as fid:
+        if fin not in _worker_hdrs:
+            _worker_hdrs[fin] = drsreader.readHeader(fid, verbose=False)
+        hdr = _worker_hdrs[fin]
+        evt_size = drsreader.eventDtype(hdr["channels"]).itemsize
+        fid.seek(hdr["data_offset"] + start*evt_size)
+        evts = drsreader.readEvents(fid, hdr["channels"], stop-start)
+    return decodeChunk(evts, hdr, read_chn, polarity, compact, feats)
+
+def iterChunks(fin, fid, hdr, read_chn, polarity, compact, evt_chunk, nworkers=1, feats=None):
+    # decoded chunks of events in file order. with nworkers>1, the file is
+    # split into contiguous event ranges that are decoded in worker
+    # processes, with at most 2*nworkers chunks in flight at once
+    if nworkers <= 1:
+        while True:
+            evts = drsreader.readEvents(fid, hdr["channels"], evt_chunk)
+            if evts.size == 0:
+                break
+            yield decodeChunk(evts, hdr, read_chn, polarity, compact, feats)
+        return
+
+    # records are fixed-size, so the event ranges follow from the file size
+    evt_size = drsreader.eventDtype(hdr["channels"]).itemsize
+    nevt = (os.path.getsize(fin) - hdr["data_offset"]) // evt_size
+    ranges = [(fin, i, min(i+evt_chunk, nevt), read_chn, polarity, compact, feats)
+              for i in range(0, nevt, evt_chunk)]
+
+    pool = multiprocessing.Pool(nworkers)
+    pending = collections.deque()
+    try:
+        for rng in ranges:
+            pending.append(pool.apply_async(_decodeRange, (rng,)))
+            if len(pending) >= 2*nworkers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+class OutputTree:
+    # the output file and its Events tree. the tree is created inside the
+    # file and its baskets are flushed as they fill, instead of holding
+    # every event in memory until the end
+
+    def __init__(self, outname, hdr, read_chn, compact, firstDate, mem_bytes, feats=None):
+        self.hdr = hdr
+        self.read_chn = read_chn
+        self.compact = compact
+        self.feats = feats
+        self.n_evt = 0
+        # the trigger cell histogram is all that's needed for the sampling rate
+        self.tc_counts = np.zeros(N_BINS, dtype=int)
+
+        self.testDate = r.TNamed("date",str(firstDate).split(".")[0])
+        self.fout = r.TFile(outname, "RECREATE")
+
+        self.ts = {c: np.zeros(1024, dtype='float') for c in read_chn}
+        self.vs = {c: np.zeros(1024, dtype='float') for c in read_chn}
+        self.adcs = {c: np.zeros(1024, dtype=np.uint16) for c in read_chn}
+        self.t = r.TTree("Events","Events")
+        self.timestamp = array('d',[0])
+        self.trig_cell = np.zeros(1, dtype=np.uint16)
+        self.rangeCtr = np.zeros(1, dtype=np.uint16)
+        self.t.Branch("timestamp",self.timestamp,'timestamp/D')
+        self.t.Branch("trig_cell",self.trig_cell,'trig_cell/s')
+        if compact:
+            self.t.Branch("range",self.rangeCtr,'range/s')
+        self.chanArray = r.TArrayI(len(read_chn))
+        for i,c in enumerate(read_chn):
+            self.chanArray.SetAt(c,i)
+            extra = "_"+str(c)
+            if compact:
+                self.t.Branch("adc"+extra, self.adcs[c], 'adc{0}[1024]/s'.format(extra))
+            else:
+                self.t.Branch("times"+extra, self.ts[c], 'times{0}[1024]/D'.format(extra))
+                self.t.Branch("voltages"+extra, self.vs[c], 'voltages{0}[1024]/D'.format(extra))
+
+        # pulse features computed during the conversion
+        self.featBufs = {}
+        if feats is not None:
+            for c in read_chn:
+                for k in features.FEATURE_NAMES:
+                    name = k+"_"+str(c)
+                    self.featBufs[name] = np.zeros(1, dtype=float)
+                    self.t.Branch(name, self.featBufs[name], name+'/D')
+
+        n_branch = self.t.GetListOfBranches().GetEntries()
+        basket_size = int(min(MAX_BASKET_SIZE, mem_bytes / n_branch))
+        self.t.SetBasketSize("*", basket_size)
+        self.t.SetAutoFlush(-int(mem_bytes))
+        self.t.SetMaxVirtualSize(int(mem_bytes))
+
+    def fill(self, chunk):
+        # fill the tree with a chunk from decodeChunk
+        self.tc_counts += np.bincount(chunk["trig_cell"], minlength=N_BINS)
+
+        for ievt in range(chunk["timestamp"].size):
+            self.n_evt += 1
+            self.timestamp[0] = chunk["timestamp"][ievt]
+            self.trig_cell[0] = chunk["trig_cell"][ievt]
+            self.rangeCtr[0] = chunk["range"][ievt]
+            for j,c in enumerate(self.read_chn):
+                if self.compact:
+                    np.copyto(self.adcs[c], chunk["adc"][j][ievt])
+                else:
+                    np.copyto(self.ts[c], chunk["times"][ievt,j])
+                    np.copyto(self.vs[c], chunk["voltages"][ievt,j])
+            for name in self.featBufs:
+                self.featBufs[name][0] = chunk[name][ievt]
+
+            self.t.Fill()
+
+    def save(self):
+        # make the entries so far readable by someone else opening the file
+        self.t.AutoSave("SaveSelf")
+        self.fout.Flush()
+
+    def close(self, polarity, verbose=True):
+        self.fout.cd()
+        sampleRate = drsreader.getSampleRate(self.hdr, self.read_chn, self.tc_counts)
+        if verbose:
+            print("Measured sampling rate: {0:.2f} GHz".format(sampleRate))
+        # print str(firstDate)
+        testDouble = r.TParameter(float)("sampleRate",sampleRate) 
+        self.t.Write("Events", r.TObject.kWriteDelete)
+        testDouble.Write()
+        self.testDate.Write()
+        self.fout.WriteObject(self.chanArray,"chans")
+        r.TNamed("settings", getSettings(self.read_chn, polarity, self.compact, self.feats)).Write()
+        if self.feats is not None:
+            # the settings the features were computed with
+            r.TParameter(float)("tstart",self.feats["tstart"]).Write()
+            r.TParameter(float)("tend",self.feats["tend"]).Write()
+        if self.compact:
+            # everything needed to rebuild the times and voltages (see treeio.py)
+            channels = self.hdr["channels"]
+            fileChans = r.TArrayI(len(channels))
+            binWidths = r.TArrayF(len(channels)*N_BINS)
+            for i,c in enumerate(channels):
+                fileChans.SetAt(c,i)
+                for j in range(N_BINS):
+                    binWidths.SetAt(self.hdr["bin_widths"][i,j], i*N_BINS+j)
+            self.fout.WriteObject(fileChans,"fileChans")
+            self.fout.WriteObject(binWidths,"binWidths")
+            r.TParameter(int)("polarity",polarity).Write()
+        self.fout.Close()
+
+def getChunkSize(hdr, read_chn, mem_bytes, feats=None):
+    # number of events that fit in mem_bytes once decoded, including the
+    # temporaries of the features if they're computed (one channel at a
+    # time; measured at up to 25 kB/event, and 45 kB/event with timing)
+    evt_bytes = drsreader.eventDtype(hdr["channels"]).itemsize + 3*8*N_BINS*len(read_chn)
+    if feats is not None:
+        evt_bytes += (6 if feats["template"] is not None else 4)*8*N_BINS
+    return max(1, int(mem_bytes / evt_bytes))
+
+def convertFile(fin, outdir, read_chn=READ_CHN, polarity=POLARITY, compact=COMPACT,
+                max_memory_mb=MAX_MEMORY_MB, nworkers=1, verbose=True, feats=None):
+    # convert a single .dat file, decoding on nworkers processes. with
+    # feats (see decodeChunk), the pulse features are stored alongside the
+    # waveforms. returns the output name, number of events and time taken
+    if type(read_chn) == int:
+        read_chn = [read_chn]
+    tstart = time.time()
+    tag = os.path.basename(fin)
+
+    fid = open(fin,'rb')
+
+    hdr = drsreader.readHeader(fid, verbose)
+    channels = hdr["channels"]
+
+    for c in read_chn:
+        if c not in channels:
+            raise Exception("set to read channel {0}, but it isn't in {1}!".format(c, fin))
+
+    # the output name carries the date of the first event, so peek at it
+    # before opening the output file
+    firstDate = getFirstDate(fin)
+    outname = getOutputName(fin, outdir, firstDate)
+
+    # split the memory budget between the decoded events and the tree baskets
+    mem_bytes = max_memory_mb * 1024**2
+    out = OutputTree(outname, hdr, read_chn, compact, firstDate, mem_bytes/2, feats)
+    evt_chunk = getChunkSize(hdr, read_chn, mem_bytes/2 / (2*max(nworkers,1)), feats)
+
+    for chunk in iterChunks(fin, fid, hdr, read_chn, polarity, compact, evt_chunk, nworkers, feats):
+        out.fill(chunk)
+        print("{0}: {1} events, {2:.0f} evts/s".format(tag, out.n_evt, out.n_evt/(time.time()-tstart)))
+
+    fid.close()
+    out.close(polarity, verbose)
+
+    return outname, out.n_evt, time.time()-tstart
+
+def waitForHeader(fin, poll, timeout):
+    # open a .dat file that is still being written once its header and
+    # first event record are complete. returns the open file and header
+    tlast = time.time()
     while True:
-        chdr = getStr(fid, 3)
-        if chdr != "C00":
-            fid.seek(-3, 1)
-            break
-        cnum = int(getStr(fid, 1))
-        print("  Found channel #"+str(cnum))
-        channels.append(cnum)
-        bin_widths[n_boards-1].append(getFloat(fid, N_BINS))
-
-    if len(bin_widths[n_boards-1])==0:
-        print("ERROR: Board #{0} doesn't have any channels!".format(board_ids[-1]))
-
-if n_boards==0:
-    print("ERROR: didn't find any valid boards!")
-    exit(1)
-
-if n_boards > 1:
-    print("ERROR: only support one board. Found {0} in file.".format(n_boards))
-    exit(1)
-
-for c in READ_CHN:
-    if c not in channels:
-        print("ERROR: set to read channel {0}, but it isn't in the file!".format(c))
-        exit(1)
-
-bin_widths = bin_widths[0]
-n_chan = len(bin_widths)
-rates = []
-
-n_evt = 0
-firstDate = None
-while True:
-    ehdr = getStr(fid, 4)
-    if ehdr == None:
-        break
-    if ehdr != "EHDR":
-        raise Exception("Bad event header!")
-
-    n_evt += 1
-    # print "Found Event #"+str(n_evt)
-    serial = getInt(fid)
-    # print "  Serial #"+str(serial)
-    dateIn = getShort(fid, 7)
-    date = dt.datetime(*dateIn[:6], microsecond=1000*dateIn[6])
-    timestamp[0] = (date - dt.datetime(1970,1,1)).total_seconds()
-    if not firstDate:
-        firstDate = str(timestamp[0])
-    rangeCtr = getShort(fid)
-    # print "  Range Center: "+str(rangeCtr)
-    getStr(fid, 2)
-    b_num = getShort(fid)
-    getStr(fid, 2)
-    trig_cell = getShort(fid)
-    # print "  Trigger Cell: "+str(trig_cell)
-
-    time0 = None
-    for ichn in range(n_chan):
-        chdr = getStr(fid, 4)
-        if chdr != "C00"+str(channels[ichn]):
-            print("ERROR: bad event data!")
-            exit(1)
-
-        scaler = getInt(fid)
-        voltages = np.array(getShort(fid, N_BINS))
-        if channels[ichn] not in READ_CHN:
-            continue
-        voltages = voltages/65535. * 1000 - 500 + rangeCtr
-        voltages *= POLARITY
-        times = np.roll(np.array(bin_widths[ichn]), N_BINS-trig_cell)
-        times = np.cumsum(times)
-        times = np.append([0], times[:-1])
-        rates.append((times[-1]-times[0])/(times.size-1))
-
-        if time0 is None:
-            time0 = times[(N_BINS-trig_cell) % N_BINS]
+        if os.path.exists(fin):
+            fid = open(fin,'rb')
+            try:
+                hdr = drsreader.readHeader(fid, verbose=False)
+                # the header is only complete once the first event has started
+                if drsreader.readEvents(fid, hdr["channels"], 1).size == 1:
+                    fid.seek(hdr["data_offset"])
+                    return fid, hdr
+            except Exception:
+                pass
+            fid.close()
+        if time.time()-tlast > timeout:
+            raise Exception("timed out waiting for the first event in {0}".format(fin))
+        time.sleep(poll)
+
+def iterFollow(fid, hdr, evt_chunk, poll, timeout):
+    # yield record arrays of the complete events in fid as they are
+    # written, until the file hasn't grown for timeout seconds. a partly
+    # written record is left for the next read
+    tlast = time.time()
+    while True:
+        evts = drsreader.readEvents(fid, hdr["channels"], evt_chunk)
+        if evts.size > 0:
+            tlast = time.time()
+            yield evts
+        elif time.time()-tlast > timeout:
+            return
         else:
-            times -= (times[(N_BINS-trig_cell) % N_BINS] - time0)
-
-        np.copyto(ts[channels[ichn]], times)
-        np.copyto(vs[channels[ichn]], voltages)
-        
-    t.Fill()
-
-testDate = r.TNamed("date",str(firstDate).split(".")[0])
-fout = r.TFile(outdir+"/{0}_{1}.root".format(name,testDate.GetTitle()), "RECREATE")
-print("Measured sampling rate: {0:.2f} GHz".format(1.0/np.mean(rates)))
-# print str(firstDate)
-testDouble = r.TParameter(float)("sampleRate",1.0/np.mean(rates)) 
-t.Write("Events", r.TObject.kWriteDelete)
-testDouble.Write()
-testDate.Write()
-fout.WriteObject(chanArray,"chans")
-fout.Close()
-
-
-
-
+            time.sleep(poll)
+
+def followFile(fin, outdir, read_chn=READ_CHN, polarity=POLARITY, compact=COMPACT,
+               max_memory_mb=MAX_MEMORY_MB, poll=2.0, timeout=60.0, window=1000, feats=None,
+               pulse_window=(TSTART, TEND)):
+    # convert a .dat file while the DRS is still writing it, appending new
+    # events to the output as they arrive and printing rolling statistics
+    # over the last window events: the event rate from the timestamps, and
+    # the mean area and noise per channel, computed as in postprocess.py
+    # with the pulse window (tstart, tend) (or taken from the features, if
+    # feats is given). stops once the file hasn't grown for timeout seconds
+    if type(read_chn) == int:
+        read_chn = [read_chn]
+    tstart = time.time()
+    tag = os.path.basename(fin)
+
+    fid, hdr = waitForHeader(fin, poll, timeout)
+    for c in read_chn:
+        if c not in hdr["channels"]:
+            raise Exception("set to read channel {0}, but it isn't in {1}!".format(c, fin))
+
+    first = drsreader.readEvents(fid, hdr["channels"], 1)
+    fid.seek(hdr["data_offset"])
+    firstDate = str(float(drsreader.getTimestamps(first["date"])[0]))
+    outname = getOutputName(fin, outdir, firstDate)
+
+    mem_bytes = max_memory_mb * 1024**2
+    out = OutputTree(outname, hdr, read_chn, compact, firstDate, mem_bytes/2, feats)
+    evt_chunk = getChunkSize(hdr, read_chn, mem_bytes/2, feats)
+
+    recent = {"timestamp": np.zeros(0)}
+    for c in read_chn:
+        recent["area_"+str(c)] = np.zeros(0)
+        recent["noise_"+str(c)] = np.zeros(0)
+
+    for evts in iterFollow(fid, hdr, evt_chunk, poll, timeout):
+        chunk = decodeChunk(evts, hdr, read_chn, polarity, compact, feats)
+        out.fill(chunk)
+        out.save()
+
+        # the statistics reuse the waveforms (or features) already decoded
+        # for the tree. only a compact output without features has to
+        # decode the last window separately
+        if feats is None:
+            if "times" in chunk:
+                times, volts = chunk["times"][-window:], chunk["voltages"][-window:]
+            else:
+                _, _, times, volts = drsreader.decodeEvents(evts[-window:], hdr, read_chn, polarity)
+        recent["timestamp"] = np.append(recent["timestamp"], chunk["timestamp"][-window:])[-window:]
+        line = "{0}: {1} events".format(tag, out.n_evt)
+        if recent["timestamp"].size > 1:
+            dt = recent["timestamp"][-1] - recent["timestamp"][0]
+            line += ", rate {0:.1f} Hz".format((recent["timestamp"].size-1)/dt if dt > 0 else 0.)
+        for j,c in enumerate(read_chn):
+            if feats is None:
+                res = features.computeFeatures(times[:,j], -volts[:,j], pulse_window[0], pulse_window[1],
+                                               groups=["baseline", "area"])
+            else:
+                res = {k: chunk[k+"_"+str(c)][-window:] for k in ["area", "noise"]}
+            for k in ["area", "noise"]:
+                recent[k+"_"+str(c)] = np.append(recent[k+"_"+str(c)], res[k])[-window:]
+            line += ", ch{0} area {1:.1f} noise {2:.2f}".format(c, np.mean(recent["area_"+str(c)]),
+                                                                np.mean(recent["noise_"+str(c)]))
+        print(line)
+
+    fid.close()
+    out.close(polarity)
+
+    return outname, out.n_evt, time.time()-tstart
+
+def _convert(args):
+    # pool worker, so that one bad file doesn't stop the others
+    fin, kwargs = args
+    try:
+        return fin, convertFile(fin, **kwargs), None
+    except Exception as e:
+        return fin, None, str(e)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert DRS .dat files to ROOT")
+    parser.add_argument("inputs", nargs="*", help=".dat files or glob patterns (default: {0})".format(fin))
+    parser.add_argument("-o", "--outdir", default=outdir, help="output directory")
+    parser.add_argument("-c", "--chans", type=int, nargs="+", default=READ_CHN, help="channels to read")
+    parser.add_argument("-p", "--polarity", type=int, choices=[1,-1], default=POLARITY)
+    parser.add_argument("--compact", action="store_true", default=COMPACT, help="store raw ADC counts")
+    parser.add_argument("--max-memory", type=int, default=MAX_MEMORY_MB, help="memory ceiling per file (MB)")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument("-f", "--force", action="store_true", help="convert even if the output is up to date")
+    parser.add_argument("--features", action="store_true",
+                        help="also compute the postprocess.py pulse features during the conversion")
+    parser.add_argument("--tstart", type=float, default=TSTART, help="start of the pulse window (ns)")
+    parser.add_argument("--tend", type=float, default=TEND, help="end of the pulse window (ns)")
+    parser.add_argument("--template", default=None,
+                        help="peak template pickle; if given, the pulse timing is computed too")
+    parser.add_argument("--follow", action="store_true",
+                        help="convert a single file while it is still being written")
+    parser.add_argument("--poll", type=float, default=2.0, help="seconds between checks for new events")
+    parser.add_argument("--timeout", type=float, default=60.0,
+                        help="stop following once the file hasn't grown for this many seconds")
+    args = parser.parse_args(argv)
+
+    feats = None
+    if args.features:
+        feats = {"tstart": args.tstart, "tend": args.tend,
+                 "template": features.loadTemplate(args.template) if args.template else None}
+
+    if args.follow:
+        if len(args.inputs) != 1:
+            parser.error("--follow takes exactly one input file")
+        if not os.path.exists(args.outdir):
+            os.makedirs(args.outdir)
+        outname, n_evt, dt = followFile(args.inputs[0], args.outdir, args.chans, args.polarity, args.compact,
+                                        args.max_memory, args.poll, args.timeout, feats=feats,
+                                        pulse_window=(args.tstart, args.tend))
+        print("{0} -> {1}: {2} events in {3:.1f} s".format(args.inputs[0], outname, n_evt, dt))
+        return 0
+
+    files = []
+    for pattern in (args.inputs or [fin]):
+        matches = sorted(glob.glob(pattern))
+        if len(matches)==0:
+            print("WARNING: no files match {0}".format(pattern))
+        files += [f for f in matches if f not in files]
+
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+
+    settings = getSettings(args.chans, args.polarity, args.compact, feats)
+    todo = []
+    for f in files:
+        if not args.force and isUpToDate(f, args.outdir, settings):
+            print("Skipping {0}, output is up to date".format(f))
+        else:
+            todo.append(f)
+    if len(todo)==0:
+        return 0
+
+    # several files are converted in parallel, while a single file is
+    # itself split across the workers
+    njobs = max(1, min(args.jobs, len(todo)))
+    kwargs = {"read_chn": args.chans, "polarity": args.polarity, "compact": args.compact,
+              "max_memory_mb": args.max_memory, "verbose": len(todo)==1,
+              "nworkers": args.jobs if len(todo)==1 else 1, "feats": feats}
+    tstart = time.time()
+    if njobs == 1:
+        results = map(_convert, [(f, kwargs) for f in todo])
+    else:
+        pool = multiprocessing.Pool(njobs)
+        results = pool.imap_unordered(_convert, [(f, kwargs) for f in todo])
+
+    nfail = 0
+    ntot = 0
+    for i,(f,res,err) in enumerate(results):
+        if err is not None:
+            nfail += 1
+            print("[{0}/{1}] ERROR converting {2}: {3}".format(i+1, len(todo), f, err))
+            continue
+        outname, n_evt, dt = res
+        ntot += n_evt
+        print("[{0}/{1}] {2} -> {3}: {4} events in {5:.1f} s ({6:.0f} evts/s)".format(
+            i+1, len(todo), f, outname, n_evt, dt, n_evt/max(dt,1e-9)))
+
+    if njobs > 1:
+        pool.close()
+        pool.join()
+    dt = time.time()-tstart
+    print("Converted {0} files, {1} events in {2:.1f} s ({3:.0f} evts/s)".format(
+        len(todo)-nfail, ntot, dt, ntot/max(dt,1e-9)))
+    return 1 if nfail else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
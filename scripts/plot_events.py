@@ -5,6 +5,8 @@ import numpy as np
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import drsreader
 
 name = "r878_1450V_1p90V_13ns_300Hz_50000evnts"
 # name = "afterpulses/r7725_1450V_2p4V_13ns_300Hz_1p0GHz_500000evnts"
@@ -15,14 +17,13 @@ outdir = "/home/users/bemarsh/public_html/milliqan/pmt_calib/plots/{0}/".format(
 os.system("mkdir -p {0}".format(outdir))
 os.system("cp ~/scripts/index.php {0}".format(outdir))
 
-f = r.TFile("/nfs-7/userdata/bemarsh/milliqan/pmt_calib/processed/{0}.root".format(name))
-t = f.Get("Events")
-
-times = np.zeros(1024, dtype=float)
-voltages = np.zeros(1024, dtype=float)
-
-t.SetBranchAddress("times",times)
-t.SetBranchAddress("voltages",voltages)
+fname = "/nfs-7/userdata/bemarsh/milliqan/pmt_calib/processed/{0}.root".format(name)
+# a raw DRS .dat file can also be given, in which case channel chan is plotted
+if len(sys.argv) > 1:
+    fname = sys.argv[1]
+chan = 1
+# index of the first event to plot
+firstEvt = int(sys.argv[2]) if len(sys.argv) > 2 else 0
 
 plt.figure(1)
 
@@ -38,11 +39,27 @@ plt.figure(1)
 tstart = 230
 tend   = 330
 
-Nevt = t.GetEntries()
+def getEvents(fname, first, nevt):
+    # yield (index, times, voltages) for nevt events starting at first
+    if fname.endswith(".dat"):
+        # seek straight to the events with the sidecar index
+        _, _, ts, vs = drsreader.readEventRange(fname, first, first+nevt, [chan])
+        for i in range(ts.shape[0]):
+            yield first+i, ts[i,0], vs[i,0]
+        return
+    f = r.TFile(fname)
+    t = f.Get("Events")
+    times = np.zeros(1024, dtype=float)
+    voltages = np.zeros(1024, dtype=float)
+    t.SetBranchAddress("times",times)
+    t.SetBranchAddress("voltages",voltages)
+    for i in range(first, min(first+nevt, t.GetEntries())):
+        t.GetEntry(i)
+        yield i, times, voltages
+
 # for i in range(Nevt):
-for i in range(50):
+for i,times,voltages in getEvents(fname, firstEvt, 50):
 # for i in range(267,268):
-    t.GetEntry(i)
 
     vs = -voltages
 
@@ -0,0 +1,211 @@
+## move data between ROOT trees and numpy arrays a chunk of events
+## at a time, and read back the output of processBinary.py (either
+## schema) as batches of calibrated times and voltages
+
+import numpy as np
+import ROOT as r
+import drsreader
+
+LEAF_TYPES = {
+    "Double_t": np.float64,
+    "Float_t": np.float32,
+    "Long64_t": np.int64,
+    "ULong64_t": np.uint64,
+    "Int_t": np.int32,
+    "UInt_t": np.uint32,
+    "Short_t": np.int16,
+    "UShort_t": np.uint16,
+    "Bool_t": np.bool_,
+    }
+
+def readBranches(tree, branches, start=0, stop=None):
+    # read fixed-size branches for entries [start, stop) into a dict of
+    # numpy arrays, of shape [N] for scalars and [N,len] for arrays.
+    # only the requested branches are read from disk
+    if stop is None or stop > tree.GetEntries():
+        stop = tree.GetEntries()
+    n = max(0, stop-start)
+
+    # only read the requested branches, and leave the others as they were
+    status = {}
+    for br in tree.GetListOfBranches():
+        status[br.GetName()] = tree.GetBranchStatus(br.GetName())
+    bufs = {}
+    out = {}
+    tree.SetBranchStatus("*", 0)
+    for b in branches:
+        leaf = tree.GetLeaf(b)
+        if not leaf:
+            raise Exception("no branch {0} in tree {1}".format(b, tree.GetName()))
+        length = leaf.GetLenStatic()
+        bufs[b] = np.zeros(length, dtype=LEAF_TYPES[leaf.GetTypeName()])
+        out[b] = np.zeros((n,length) if length > 1 else n, dtype=bufs[b].dtype)
+        tree.SetBranchStatus(b, 1)
+        tree.SetBranchAddress(b, bufs[b])
+
+    for i in range(n):
+        tree.GetEntry(start+i)
+        for b in branches:
+            out[b][i] = bufs[b] if bufs[b].size > 1 else bufs[b][0]
+
+    for b in branches:
+        tree.ResetBranchAddress(tree.GetBranch(b))
+    for name,st in status.items():
+        tree.SetBranchStatus(name, st)
+    return out
+
+def getChannels(f):
+    # channels stored in an output file of processBinary.py
+    chans = f.Get("chans")
+    return [chans.At(i) for i in range(chans.GetSize())]
+
+def isCompact(f):
+    # whether the file was written with the raw ADC schema
+    return bool(f.Get("binWidths"))
+
+def getHeader(f):
+    # rebuild the parts of the .dat header needed for the time axes
+    # from a file written with the raw ADC schema
+    fileChans = f.Get("fileChans")
+    fileChans = [fileChans.At(i) for i in range(fileChans.GetSize())]
+    binWidths = f.Get("binWidths")
+    bin_widths = np.array([binWidths.At(i) for i in range(binWidths.GetSize())], dtype=float)
+    return {"channels": fileChans,
+            "bin_widths": bin_widths.reshape(len(fileChans), drsreader.N_BINS)}
+
+def iterTree(fname, batch_size=1000, channels=None, start=0, stop=None):
+    # generator over the Events tree of a processBinary.py output file,
+    # yielding (timestamps, trig_cells, times[N,nch,1024], voltages[N,nch,1024])
+    # like drsreader.iterEvents. files written with the raw ADC schema are
+    # calibrated on the fly, a batch at a time. trig_cells is None for
+    # files that don't store them
+    f = r.TFile.Open(fname)
+    t = f.Get("Events")
+    chans = getChannels(f)
+    if channels is None:
+        channels = chans
+    for c in channels:
+        if c not in chans:
+            raise Exception("set to read channel {0}, but it isn't in the file!".format(c))
+    has_tc = bool(t.GetBranch("trig_cell"))
+
+    if stop is None or stop > t.GetEntries():
+        stop = t.GetEntries()
+
+    compact = isCompact(f)
+    if compact:
+        hdr = getHeader(f)
+        polarity = f.Get("polarity").GetVal()
+        ichans = [chans.index(c) for c in channels]
+        branches = ["timestamp", "trig_cell", "range"] + ["adc_{0}".format(c) for c in channels]
+    else:
+        branches = ["timestamp"] + (["trig_cell"] if has_tc else [])
+        for c in channels:
+            branches += ["times_{0}".format(c), "voltages_{0}".format(c)]
+
+    for istart in range(start, stop, batch_size):
+        d = readBranches(t, branches, istart, min(istart+batch_size, stop))
+        trig_cells = d["trig_cell"].astype(int) if has_tc else None
+        if compact:
+            # the time table is built for all of the stored channels, so that
+            # the alignment between them is the same as in the conversion
+            times = drsreader.getTimeTable(hdr, chans)[trig_cells][:,ichans,:]
+            voltages = np.stack([drsreader.getVoltages(d["adc_{0}".format(c)], d["range"]) * polarity
+                                 for c in channels], axis=1)
+        else:
+            times = np.stack([d["times_{0}".format(c)] for c in channels], axis=1)
+            voltages = np.stack([d["voltages_{0}".format(c)] for c in channels], axis=1)
+        yield d["timestamp"], trig_cells, times, voltages
+
+    f.Close()
+
+class BranchWriter(object):
+    # double branches added to a tree: one per scalar name, plus variable
+    # length ones (one per array name, all sized by the count branch) for
+    # ragged per-event quantities. fill() writes a batch of events from
+    # numpy arrays. if fill_tree is False (e.g. branches added to a
+    # CloneTree that already has its entries) the branches are filled on
+    # their own, else the whole tree is
+    def __init__(self, tree, scalars, arrays=None, count=None, fill_tree=True):
+        self.t = tree
+        self.scalars = list(scalars)
+        self.arrays = list(arrays or [])
+        self.count = count
+        self.fill_tree = fill_tree
+        self.bufs = {}
+        self.branches = []
+        for k in self.scalars:
+            self.bufs[k] = np.zeros(1, dtype=float)
+            self.branches.append(self.t.Branch(k, self.bufs[k], k+"/D"))
+        if self.arrays:
+            self.bufs[count] = np.zeros(1, dtype=np.uint32)
+            self.branches.append(self.t.Branch(count, self.bufs[count], count+"/i"))
+            for k in self.arrays:
+                self.bufs[k] = np.zeros(16, dtype=float)
+                self.branches.append(self.t.Branch(k, self.bufs[k], "{0}[{1}]/D".format(k, count)))
+
+    def grow(self, n):
+        # make the array buffers big enough for n entries
+        size = self.bufs[self.arrays[0]].size
+        while size < n:
+            size *= 2
+        for k in self.arrays:
+            self.bufs[k] = np.zeros(size, dtype=float)
+            self.t.GetBranch(k).SetAddress(self.bufs[k])
+
+    def fill(self, res, ragged=None):
+        # append the events of res, a dict of [N] arrays keyed by the scalar
+        # names. the array branches are filled from ragged, a dict of flat
+        # arrays keyed by the array names, with the entries of event i in
+        # [offsets[i], offsets[i+1])
+        n = len(res[self.scalars[0]]) if self.scalars else len(ragged["offsets"])-1
+        for i in range(n):
+            for k in self.scalars:
+                self.bufs[k][0] = res[k][i]
+            if self.arrays:
+                lo, hi = ragged["offsets"][i], ragged["offsets"][i+1]
+                if hi-lo > self.bufs[self.arrays[0]].size:
+                    self.grow(hi-lo)
+                self.bufs[self.count][0] = hi-lo
+                for k in self.arrays:
+                    self.bufs[k][:hi-lo] = ragged[k][lo:hi]
+            if self.fill_tree:
+                self.t.Fill()
+            else:
+                for b in self.branches:
+                    b.Fill()
+        return n
+
+class FeatureTree(object):
+    # a tree of per-event derived quantities only (see BranchWriter),
+    # written to its own file so that it can be attached to the Events tree
+    # it was made from with AddFriend. entry i of the feature tree belongs
+    # to entry i of the Events tree. the parameters the features were made
+    # with are kept in the tree's UserInfo, so that several versions can
+    # sit side by side under different tree names
+    def __init__(self, fname, treename, names, params=None, arrays=None, count=None):
+        self.f = r.TFile(fname, "UPDATE")
+        self.t = r.TTree(treename, treename)
+        self.writer = BranchWriter(self.t, names, arrays, count)
+        info = self.t.GetUserInfo()
+        for k,v in (params or {}).items():
+            if isinstance(v, (int, float)):
+                info.Add(r.TParameter(float)(k, v))
+            else:
+                info.Add(r.TNamed(k, str(v)))
+        self.n_evt = 0
+
+    def fill(self, res, ragged=None):
+        self.n_evt += self.writer.fill(res, ragged)
+
+    def close(self):
+        self.f.cd()
+        self.t.Write(self.t.GetName(), r.TObject.kWriteDelete)
+        self.f.Close()
+
+def getParams(tree):
+    # the parameters stored with a FeatureTree, as a dict
+    params = {}
+    for obj in tree.GetUserInfo():
+        params[obj.GetName()] = obj.GetVal() if hasattr(obj, "GetVal") else obj.GetTitle()
+    return params